@@ -1,4 +1,6 @@
-from changed_terms_analysis.analyze import main
+from changed_terms_analysis.analyze import (LARGE_DOCUMENT_SIZE,
+                                            MIN_WORKER_MEMORY_LIMIT, main)
+from changed_terms_analysis.extractors import EXTRACTORS
 import sys
 
 if __name__ == '__main__':
@@ -6,8 +8,50 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Count term changes in monitored pages.')
     parser.add_argument('--pattern', help='Only analyze pages with URLs matching this pattern.')
     parser.add_argument('--ngrams', type=int, default=2, help='Number of words in combination to track.')
+    parser.add_argument('--key-terms', help='Path to a file of key terms (one per line) to use instead of KEY_TERMS.')
+    parser.add_argument('--key-terms-only', action='store_true',
+                        help='Only count changes to the key terms instead of all n-grams (much faster).')
+    parser.add_argument('--output-format', choices=('json', 'columnar'), default='json',
+                        help='Write JSON lines to stdout or a columnar directory to the --output path.')
+    parser.add_argument('--output', help='Path to write output to (for --output-format=columnar).')
     parser.add_argument('--sqlite', help='Output results in a sqlite DB at this path.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Update an existing sqlite DB, only analyzing pages that changed since it was written.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted run, skipping pages already recorded in the --sqlite DB.')
+    parser.add_argument('--retry-failed', action='store_true',
+                        help='Only analyze pages that failed in the --sqlite DB, and update it with the results.')
+    parser.add_argument('--sqlite-timings', action='store_true',
+                        help='Store the seconds spent on each stage of analysis for each page in the sqlite DB.')
+    parser.add_argument('--stats', help='Write per-stage timings and throughput for the run as JSON to this path.')
+    parser.add_argument('--sqlite-batch-size', type=int, default=1000,
+                        help='Number of pages to write to the sqlite DB per transaction.')
     parser.add_argument('--cache', action='store_true', help='Cache HTTP requests')
+    parser.add_argument('--text-cache', help='Cache the text extracted from versions in a SQLite DB at this path.')
+    parser.add_argument('--text-cache-size', type=int, default=1024,
+                        help='Maximum size of the text cache in megabytes.')
+    parser.add_argument('--diff', choices=('character', 'word'), default='character',
+                        help='Diff texts character-by-character or word-by-word (faster).')
+    parser.add_argument('--history', action='store_true',
+                        help='Analyze the changes between every version of each page, not just the first and last.')
+    parser.add_argument('--extractor', choices=tuple(EXTRACTORS), default='readability',
+                        help='How to find the main content of pages: with the readability server, or in-process with lxml.')
+    parser.add_argument('--large-document-size', type=int, default=LARGE_DOCUMENT_SIZE,
+                        help='Diff pages whose texts are longer than this many characters in chunks (0 to never chunk).')
+    parser.add_argument('--worker-memory-limit', type=int,
+                        help='Maximum data memory (in megabytes) each worker process can allocate.')
+    parser.add_argument('--workers', type=int, default=10,
+                        help='Number of processes to analyze pages with.')
+    parser.add_argument('--fetch-threads', type=int, default=0,
+                        help='Load versions in this many threads, separately from the analysis processes.')
+    parser.add_argument('--host-rate', type=float,
+                        help='Maximum requests per second to each archive host (default: no limit).')
+    parser.add_argument('--metadata-connections', type=int, default=4,
+                        help='Number of simultaneous requests to make when loading pages from web-monitoring-db.')
+    parser.add_argument('--max-in-flight', type=int,
+                        help='Maximum pages queued for analysis at once (default: 4 × workers + fetch threads).')
+    parser.add_argument('--no-dedupe', action='store_true',
+                        help='Analyze every page, even if another page had the same content.')
     parser.add_argument('--verbose', action='store_true', help='Show details about skips and errors')
     # Need the ability to actually start/stop the readability server if we want this option
     # parser.add_argument('--readability', action='store_true', help='Only analyze pages with URLs matching this pattern.')
@@ -17,8 +61,85 @@ if __name__ == '__main__':
         print('--ngrams must be between 1 and 5.', file=sys.stderr)
         sys.exit(1)
 
+    if options.incremental and not options.sqlite:
+        print('--incremental requires --sqlite.', file=sys.stderr)
+        sys.exit(1)
+
+    if options.resume and not options.sqlite:
+        print('--resume requires --sqlite.', file=sys.stderr)
+        sys.exit(1)
+
+    if options.retry_failed and not options.sqlite:
+        print('--retry-failed requires --sqlite.', file=sys.stderr)
+        sys.exit(1)
+
+    if options.incremental + options.resume + options.retry_failed > 1:
+        print('Only one of --incremental, --resume, and --retry-failed can be used.', file=sys.stderr)
+        sys.exit(1)
+
+    if options.sqlite_timings and not options.sqlite:
+        print('--sqlite-timings requires --sqlite.', file=sys.stderr)
+        sys.exit(1)
+
+    if options.output_format == 'columnar' and not options.output:
+        print('--output-format=columnar requires --output.', file=sys.stderr)
+        sys.exit(1)
+
+    if options.history and options.fetch_threads:
+        print('--history cannot be used with --fetch-threads.', file=sys.stderr)
+        sys.exit(1)
+
+    if options.workers < 1:
+        print('--workers must be at least 1.', file=sys.stderr)
+        sys.exit(1)
+
+    if options.host_rate is not None and options.host_rate <= 0:
+        print('--host-rate must be greater than 0.', file=sys.stderr)
+        sys.exit(1)
+
+    if options.large_document_size < 0:
+        print('--large-document-size must be at least 0.', file=sys.stderr)
+        sys.exit(1)
+
+    if (options.worker_memory_limit is not None
+            and options.worker_memory_limit < MIN_WORKER_MEMORY_LIMIT):
+        print(f'--worker-memory-limit must be at least {MIN_WORKER_MEMORY_LIMIT}.',
+              file=sys.stderr)
+        sys.exit(1)
+
+    if options.metadata_connections < 1:
+        print('--metadata-connections must be at least 1.', file=sys.stderr)
+        sys.exit(1)
+
+    if options.max_in_flight is not None and options.max_in_flight < options.workers:
+        print('--max-in-flight must be at least the number of workers.', file=sys.stderr)
+        sys.exit(1)
+
     main(pattern=options.pattern,
          grams=options.ngrams,
          sqlite_path=options.sqlite,
          cache=options.cache,
-         verbose=options.verbose)
+         verbose=options.verbose,
+         diff_mode=options.diff,
+         workers=options.workers,
+         max_in_flight=options.max_in_flight,
+         text_cache_path=options.text_cache,
+         text_cache_size=options.text_cache_size,
+         dedupe=not options.no_dedupe,
+         fetch_threads=options.fetch_threads,
+         sqlite_batch_size=options.sqlite_batch_size,
+         incremental=options.incremental,
+         resume=options.resume,
+         retry_failed=options.retry_failed,
+         key_terms_path=options.key_terms,
+         key_terms_only=options.key_terms_only,
+         output_format=options.output_format,
+         output_path=options.output,
+         stats_path=options.stats,
+         sqlite_timings=options.sqlite_timings,
+         history=options.history,
+         metadata_connections=options.metadata_connections,
+         extractor=options.extractor,
+         host_rate=options.host_rate,
+         large_document_size=options.large_document_size,
+         worker_memory_limit=options.worker_memory_limit)
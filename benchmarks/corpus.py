@@ -0,0 +1,155 @@
+"""
+A fixture corpus of version pairs for benchmarking, so benchmarks don't need
+web-monitoring-db or archive storage.
+
+Each entry in the corpus is a directory in `benchmarks/corpus` with the two
+versions of a page as `a.html` and `b.html`. The standard entries are:
+
+- `small`: a typical page with a few hundred words and some changes.
+- `near_identical`: a long page where only one word changed.
+- `huge`: a multi-megabyte data listing with changes scattered throughout.
+
+`small` and `near_identical` are checked in. `huge` is too big to keep in the
+repo, so it's generated the first time it's needed. Generating is seeded, so
+it always gives the same files, and they're checked against the checksum in
+`CHECKSUMS` to make sure.
+
+You can also record real version pairs to benchmark against (and check them
+in, if they're small enough):
+
+    > python benchmarks/corpus.py record <name> <version_a_url> <version_b_url>
+
+And regenerate the standard entries with:
+
+    > python benchmarks/corpus.py generate
+"""
+import hashlib
+from html import escape
+from pathlib import Path
+import random
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from word_diff import VOCABULARY, synthetic_pair  # noqa: E402
+
+
+CORPUS_PATH = Path(__file__).resolve().parent / 'corpus'
+
+# Name -> (words on the page, fraction of words changed).
+GENERATED = {
+    'small': (500, 0.05),
+    'near_identical': (20_000, 0),
+    'huge': (400_000, 0.02),
+}
+
+# Entries that aren't checked in, and the checksum (see `entry_checksum()`)
+# they should have once they're generated.
+CHECKSUMS = {
+    'huge': '2788a16ad8f5232b2d654832141c42ca2af6d399a0cbe2749616ad03b42d8c7e',
+}
+
+PARAGRAPH_WORDS = 60
+
+BOILERPLATE = """
+<header><nav><ul>
+  <li><a href="/">Home</a></li>
+  <li><a href="/about">About Us</a></li>
+  <li><a href="/news">News Releases</a></li>
+  <li><a href="/contact">Contact Us</a></li>
+</ul></nav></header>
+"""
+
+FOOTER = """
+<footer>
+  <p>Privacy Policy | Accessibility | No FEAR Act Data | Inspector General</p>
+</footer>
+"""
+
+
+def as_html(text, title):
+    """Wrap some text in a page with navigation and paragraphs."""
+    words = text.split()
+    paragraphs = (' '.join(words[index:index + PARAGRAPH_WORDS])
+                  for index in range(0, len(words), PARAGRAPH_WORDS))
+    body = '\n'.join(f'<p>{escape(paragraph)}</p>' for paragraph in paragraphs)
+    return (f'<!doctype html>\n<html><head><title>{escape(title)}</title></head>'
+            f'<body>{BOILERPLATE}<main><h1>{escape(title)}</h1>\n{body}\n</main>'
+            f'{FOOTER}</body></html>\n')
+
+
+def generate_entry(name):
+    word_count, change_rate = GENERATED[name]
+    text_a, text_b = synthetic_pair(word_count, change_rate, seed=len(name))
+    if change_rate == 0:
+        # Change exactly one word in the middle.
+        words = text_b.split()
+        middle = len(words) // 2
+        words[middle] = random.Random(1).choice(
+            [word for word in VOCABULARY if word != words[middle]])
+        text_b = ' '.join(words)
+
+    title = name.replace('_', ' ').title()
+    write_entry(name, as_html(text_a, title), as_html(text_b, title))
+
+    checksum = entry_checksum(name)
+    if name in CHECKSUMS and checksum != CHECKSUMS[name]:
+        raise ValueError(f'Generated corpus entry {name!r} has checksum {checksum}, '
+                         f'but should have {CHECKSUMS[name]}. Benchmarks with it '
+                         f'can\'t be compared to results from other checkouts.')
+
+
+def write_entry(name, html_a, html_b):
+    path = CORPUS_PATH / name
+    path.mkdir(parents=True, exist_ok=True)
+    (path / 'a.html').write_text(html_a)
+    (path / 'b.html').write_text(html_b)
+
+
+def record_entry(name, url_a, url_b):
+    """Save the bodies of two real versions as a corpus entry."""
+    from changed_terms_analysis.tools import load_url
+    write_entry(name, load_url(url_a).text, load_url(url_b).text)
+
+
+def entry_checksum(name):
+    """
+    Get a SHA-256 hash of both versions of a corpus entry, to check that
+    benchmarks ran against the same inputs.
+    """
+    digest = hashlib.sha256()
+    for version in ('a.html', 'b.html'):
+        digest.update((CORPUS_PATH / name / version).read_bytes())
+    return digest.hexdigest()
+
+
+def load_corpus(names=None):
+    """
+    Get a dict of corpus entry names to `(html_a, html_b)` tuples, generating
+    any missing standard entries. If `names` is None, every entry is loaded.
+    """
+    for name in CHECKSUMS:
+        if not (CORPUS_PATH / name).exists():
+            generate_entry(name)
+
+    if names is None:
+        names = sorted(path.name for path in CORPUS_PATH.iterdir() if path.is_dir())
+
+    return {name: ((CORPUS_PATH / name / 'a.html').read_text(),
+                   (CORPUS_PATH / name / 'b.html').read_text())
+            for name in names}
+
+
+def body_hash(html):
+    return hashlib.sha256(html.encode('utf-8')).hexdigest()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['generate']:
+        for name in GENERATED:
+            generate_entry(name)
+    elif sys.argv[1:2] == ['record'] and len(sys.argv) == 5:
+        record_entry(*sys.argv[2:])
+    else:
+        print(__doc__, file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,238 @@
+"""
+Benchmark the main stages of the analysis against the fixture corpus (see
+`corpus.py`), with local stand-ins for web-monitoring-db, archive storage, and
+the readability server (see `stubs.py`), so no network access is needed.
+
+    > python benchmarks/run.py
+    > python benchmarks/run.py --entries small,huge --benchmarks net_change
+    > python benchmarks/run.py --save before
+    > python benchmarks/run.py --compare before
+
+Results are saved as JSON in `benchmarks/results/<name>.json`. `--save`
+defaults to the current git commit, so you can run this on two commits and
+compare them with `--compare <commit>`. `--compare` also takes the path to a
+results file someone else shared. Results include a checksum of each corpus
+entry and a description of the machine they ran on, and comparing warns if
+either is different.
+"""
+import argparse
+from collections import Counter
+from contextlib import contextmanager
+import json
+import os
+from pathlib import Path
+import platform
+import subprocess
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from changed_terms_analysis import analyze, tools  # noqa: E402
+from changed_terms_analysis.chunking import chunked_diff  # noqa: E402
+from changed_terms_analysis.sqlite import (sqlite_database,  # noqa: E402
+                                           write_page_to_sqlite)
+from changed_terms_analysis.tools import (CharacterToWordDiffs,  # noqa: E402
+                                          changed_ngrams,
+                                          count_changed_ngrams, net_change,
+                                          visible_text)
+from corpus import entry_checksum, load_corpus  # noqa: E402
+from stubs import StubClient, StubServer  # noqa: E402
+from web_monitoring import db  # noqa: E402
+from web_monitoring.diff import differs  # noqa: E402
+
+
+RESULTS_PATH = Path(__file__).resolve().parent / 'results'
+
+
+@contextmanager
+def stubbed_services(corpus):
+    """
+    Start a `StubServer` for the corpus and point the analysis at it instead
+    of web-monitoring-db and the readability server.
+    """
+    original_from_env = db.Client.from_env
+    original_readability = tools.READABILITY_SERVER
+    with StubServer(corpus) as server:
+        db.Client.from_env = classmethod(lambda cls: StubClient(server))
+        tools.READABILITY_SERVER = server.url
+        try:
+            yield server
+        finally:
+            db.Client.from_env = original_from_env
+            tools.READABILITY_SERVER = original_readability
+
+
+class Fixture:
+    """The inputs for each benchmark, for one entry in the corpus."""
+
+    def __init__(self, page, html_a, html_b):
+        self.page = page
+        self.text_a = visible_text(html_a)
+        self.text_b = visible_text(html_b)
+        self.raw_diff = differs.html_source_diff(self.text_a, self.text_b)['diff']
+        self.word_diff = CharacterToWordDiffs.word_diffs(self.raw_diff)
+        self.terms = (count_changed_ngrams(self.word_diff[0], 2),
+                      count_changed_ngrams(self.word_diff[1], 2))
+        self.result = {
+            **analyze.describe_page(page),
+            'percent_changed': analyze.calculate_percent_changed(self.raw_diff),
+            'terms': self.terms,
+        }
+
+
+def analyze_page(fixture, diff_mode):
+    # Don't let texts or words from the last run be reused.
+    analyze._recent_texts.clear()
+    analyze._recent_tokens.clear()
+    analyze.analyze_page(fixture.page, diff_mode=diff_mode)
+
+
+def count_ngrams_by_size(fixture, grams):
+    # How n-grams were counted before `count_changed_ngrams()`, to compare.
+    for diff in fixture.word_diff:
+        counter = Counter()
+        for size in range(1, grams + 1):
+            counter.update(changed_ngrams(diff, size))
+
+
+def write_pages(fixture, count=100):
+    with tempfile.TemporaryDirectory() as directory:
+        with sqlite_database(Path(directory, 'benchmark.db')) as database:
+            for index in range(count):
+                page = {**fixture.result, 'id': f'{fixture.result["id"]}-{index}'}
+                write_page_to_sqlite(page, database)
+
+
+BENCHMARKS = {
+    'analyze_page[character]': lambda fixture: analyze_page(fixture, 'character'),
+    'analyze_page[word]': lambda fixture: analyze_page(fixture, 'word'),
+    'chunked_diff[character]': lambda fixture: chunked_diff(fixture.text_a, fixture.text_b, 'character'),
+    'chunked_diff[word]': lambda fixture: chunked_diff(fixture.text_a, fixture.text_b, 'word'),
+    'word_diffs': lambda fixture: CharacterToWordDiffs.word_diffs(fixture.raw_diff),
+    'changed_ngrams[grams=2]': lambda fixture: count_ngrams_by_size(fixture, 2),
+    'changed_ngrams[grams=5]': lambda fixture: count_ngrams_by_size(fixture, 5),
+    'count_changed_ngrams[grams=2]': lambda fixture: [count_changed_ngrams(diff, 2)
+                                                      for diff in fixture.word_diff],
+    'count_changed_ngrams[grams=5]': lambda fixture: [count_changed_ngrams(diff, 5)
+                                                      for diff in fixture.word_diff],
+    'net_change': lambda fixture: net_change(*fixture.terms),
+    'write_page_to_sqlite[x100]': write_pages,
+}
+
+
+def run(entries=None, benchmarks=None, repeat=3):
+    """
+    Run benchmarks against corpus entries, and return a dict of benchmark
+    names to dicts of entry names to the best time in seconds.
+    """
+    corpus = load_corpus(entries)
+    benchmarks = benchmarks or list(BENCHMARKS)
+    results = {name: {} for name in benchmarks}
+    with stubbed_services(corpus):
+        pages = {page['uuid']: page for page in analyze.list_all_pages(None)}
+        for entry, (html_a, html_b) in corpus.items():
+            fixture = Fixture(pages[entry], html_a, html_b)
+            for name in benchmarks:
+                benchmark = BENCHMARKS[name]
+                seconds = min(timeit.repeat(lambda: benchmark(fixture),
+                                            number=1, repeat=repeat))
+                results[name][entry] = seconds
+                print(f'{name:>28} {entry:>16}: {seconds:9.4f}s', file=sys.stderr)
+    return results
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'latest'
+
+
+def describe_machine():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def save_results(name, results):
+    """
+    Save benchmark results (from `run()`) along with the checksum of each
+    corpus entry they used and a description of this machine.
+    """
+    entries = sorted({entry for timings in results.values() for entry in timings})
+    RESULTS_PATH.mkdir(exist_ok=True)
+    path = RESULTS_PATH / f'{name}.json'
+    path.write_text(json.dumps({
+        'machine': describe_machine(),
+        'corpus': {entry: entry_checksum(entry) for entry in entries},
+        'results': results,
+    }, indent=2))
+    return path
+
+
+def load_results(name):
+    """Load saved results by name, or from a path to a results file."""
+    path = Path(name)
+    if not path.is_file():
+        path = RESULTS_PATH / f'{name}.json'
+    return json.loads(path.read_text())
+
+
+def check_comparable(baseline, current):
+    """Warn about differences in inputs or machines between saved results."""
+    for entry, checksum in current['corpus'].items():
+        before = baseline['corpus'].get(entry)
+        if before and before != checksum:
+            print(f'Warning: corpus entry {entry!r} is different from the one the '
+                  f'baseline ran against.', file=sys.stderr)
+    if baseline['machine'] != current['machine']:
+        print(f'Warning: the baseline ran on a different machine '
+              f'({baseline["machine"]}), so times may not be comparable.', file=sys.stderr)
+
+
+def compare_results(baseline, results):
+    print(f'{"benchmark":>28} {"entry":>16} {"before":>10} {"after":>10} {"change":>8}')
+    for name, entries in results.items():
+        for entry, seconds in entries.items():
+            before = baseline.get(name, {}).get(entry)
+            if before is None:
+                print(f'{name:>28} {entry:>16} {"-":>10} {seconds:9.4f}s {"-":>8}')
+            else:
+                change = (seconds - before) / before if before else 0
+                print(f'{name:>28} {entry:>16} {before:9.4f}s {seconds:9.4f}s {change:+8.1%}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the analysis against a fixture corpus.')
+    parser.add_argument('--entries', help='Comma-separated corpus entries to run (default: all).')
+    parser.add_argument('--benchmarks', help=f'Comma-separated benchmarks to run: {", ".join(BENCHMARKS)}.')
+    parser.add_argument('--repeat', type=int, default=3, help='Times to run each benchmark (the best is kept).')
+    parser.add_argument('--save', help='Name to save results as (default: the current git commit).')
+    parser.add_argument('--compare', help='Name of saved results (or path to a results file) to compare against.')
+    options = parser.parse_args()
+
+    benchmarks = options.benchmarks and options.benchmarks.split(',')
+    unknown = set(benchmarks or ()) - set(BENCHMARKS)
+    if unknown:
+        print(f'Unknown benchmarks: {", ".join(sorted(unknown))}', file=sys.stderr)
+        sys.exit(1)
+
+    baseline = None
+    if options.compare:
+        baseline = load_results(options.compare)
+
+    results = run(entries=options.entries and options.entries.split(','),
+                  benchmarks=benchmarks,
+                  repeat=options.repeat)
+    path = save_results(options.save or current_commit(), results)
+    print(f'Saved results to {path}', file=sys.stderr)
+
+    if baseline is not None:
+        check_comparable(baseline, load_results(path))
+        compare_results(baseline['results'], results)
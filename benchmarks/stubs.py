@@ -0,0 +1,173 @@
+"""
+Local stand-ins for the services a real run talks to, so benchmarks can run
+offline and give the same results every time:
+
+- `StubServer` is an HTTP server on localhost that serves the version bodies
+  in the corpus (like archive storage) and implements the readability
+  server's `/all`, `/batch`, and `/proxy` endpoints. Instead of readability, it returns
+  the visible text of the page, so it's much faster than the real thing and
+  benchmarks measure our code, not Node.
+- `StubClient` is a replacement for `web_monitoring.db.Client` that lists a
+  page for each corpus entry.
+
+Examples
+--------
+>>> with StubServer(load_corpus()) as server:
+...     page = StubClient(server).list_pages()['data'][0]
+...     analyze_page(page)
+"""
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from pathlib import Path
+import sys
+import threading
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from changed_terms_analysis.tools import visible_text  # noqa: E402
+from corpus import body_hash  # noqa: E402
+
+
+class StubServer:
+    """
+    Serve the versions in a corpus (a dict of names to `(html_a, html_b)`, as
+    from `load_corpus()`) at `/versions/<name>/<a|b>.html`, and a stand-in for
+    the readability server. Use as a context manager to start and stop it.
+    """
+
+    def __init__(self, corpus, port=0):
+        self.corpus = corpus
+        self.port = port
+        self._server = None
+
+    @property
+    def url(self):
+        return f'http://localhost:{self._server.server_port}'
+
+    def version_url(self, name, version):
+        return f'{self.url}/versions/{name}/{version}.html'
+
+    def body(self, path):
+        """Get the body at a path on the server, or None if there isn't one."""
+        parts = path.strip('/').split('/')
+        if len(parts) == 3 and parts[0] == 'versions' and parts[1] in self.corpus:
+            index = {'a.html': 0, 'b.html': 1}.get(parts[2])
+            if index is not None:
+                return self.corpus[parts[1]][index]
+        return None
+
+    def __enter__(self):
+        self._server = ThreadingHTTPServer(('localhost', self.port), _handler(self))
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _handler(stub):
+    class StubHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/proxy':
+                target = parse_qs(url.query).get('url', [''])[0]
+                body = stub.body(urlparse(target).path)
+                if body is None:
+                    self.respond(404, 'text/plain', 'Not found')
+                else:
+                    self.respond(200, 'text/plain', visible_text(body))
+            else:
+                body = stub.body(url.path)
+                if body is None:
+                    self.respond(404, 'text/plain', 'Not found')
+                else:
+                    self.respond(200, 'text/html; charset=utf-8', body)
+
+        def do_POST(self):
+            path = urlparse(self.path).path
+            length = int(self.headers.get('Content-Length', 0))
+            if path == '/all':
+                html = self.rfile.read(length).decode('utf-8')
+                parsed = {'title': None, 'html': html, 'text': visible_text(html)}
+                self.respond(200, 'application/json', json.dumps(parsed))
+            elif path == '/batch':
+                items = json.loads(self.rfile.read(length))['items']
+                lines = []
+                for item in items:
+                    html = item.get('html')
+                    if html is None:
+                        html = stub.body(urlparse(item['url']).path)
+                    if html is None:
+                        lines.append({'id': item['id'], 'status': 500, 'error': 'Not found'})
+                    else:
+                        lines.append({'id': item['id'], 'status': 200,
+                                      'result': {'text': visible_text(html)}})
+                self.respond(200, 'application/x-ndjson',
+                             ''.join(f'{json.dumps(line)}\n' for line in lines))
+            else:
+                self.respond(404, 'text/plain', 'Not found')
+
+        def respond(self, status, content_type, body):
+            data = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    return StubHandler
+
+
+class StubClient:
+    """
+    Stand-in for `web_monitoring.db.Client` with a page for each entry in a
+    `StubServer`'s corpus. Only supports the parts of `list_pages()` the
+    analysis uses.
+    """
+
+    def __init__(self, server):
+        self.server = server
+
+    def page(self, name):
+        start = datetime(2017, 1, 1)
+
+        def version(key, days):
+            html = self.server.corpus[name][key == 'b']
+            return {
+                'uuid': f'{name}-{key}',
+                'uri': self.server.version_url(name, key),
+                'capture_url': f'https://www.example.gov/{name}',
+                'capture_time': start + timedelta(days=days),
+                'body_hash': body_hash(html),
+                'source_metadata': {'content_type': 'text/html'},
+                'status': 200,
+            }
+
+        return {
+            'uuid': name,
+            'url': f'https://www.example.gov/{name}',
+            'title': name.replace('_', ' ').title(),
+            'earliest': version('a', 0),
+            'latest': version('b', 365),
+        }
+
+    def list_pages(self, chunk=1, chunk_size=1000, include_total=False, **kwargs):
+        names = sorted(self.server.corpus)
+        start = (chunk - 1) * chunk_size
+        pages = [self.page(name) for name in names[start:start + chunk_size]]
+        has_next = start + chunk_size < len(names)
+        result = {
+            'data': pages,
+            'links': {'next': has_next and f'?chunk={chunk + 1}' or None},
+            'meta': {},
+        }
+        if include_total:
+            result['meta']['total_results'] = len(names)
+        return result
@@ -0,0 +1,81 @@
+"""
+Compare the speed of the character-based and word-based diff paths used by
+`analyze_page()`.
+
+    > python benchmarks/word_diff.py
+    > python benchmarks/word_diff.py path/to/version_a.html path/to/version_b.html
+
+With no arguments, this generates a pair of large synthetic pages. Otherwise,
+it compares the visible text of two HTML files.
+"""
+from pathlib import Path
+import random
+import sys
+import timeit
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from changed_terms_analysis.tools import (CharacterToWordDiffs,  # noqa: E402
+                                          count_changed_ngrams,
+                                          split_word_diff,
+                                          visible_text, word_level_diff)
+from web_monitoring.diff import differs  # noqa: E402
+
+
+VOCABULARY = ('climate change energy water quality air pollution emissions '
+              'national forests research program data information office '
+              'environmental resources the of and to in for on with by').split()
+
+
+def synthetic_text(word_count, seed):
+    generator = random.Random(seed)
+    return ' '.join(generator.choice(VOCABULARY) for _ in range(word_count))
+
+
+def synthetic_pair(word_count=200_000, change_rate=0.02, seed=1):
+    generator = random.Random(seed)
+    words_a = synthetic_text(word_count, seed).split()
+    words_b = []
+    for word in words_a:
+        roll = generator.random()
+        if roll < change_rate / 2:
+            continue
+        elif roll < change_rate:
+            words_b.append(generator.choice(VOCABULARY))
+        words_b.append(word)
+    return ' '.join(words_a), ' '.join(words_b)
+
+
+def character_path(text_a, text_b):
+    raw_diff = differs.html_source_diff(text_a, text_b)['diff']
+    return CharacterToWordDiffs.word_diffs(raw_diff)
+
+
+def word_path(text_a, text_b):
+    return split_word_diff(word_level_diff(text_a, text_b))
+
+
+def count_terms(word_diff, grams=2):
+    return (count_changed_ngrams(word_diff[0], grams),
+            count_changed_ngrams(word_diff[1], grams))
+
+
+def main(paths):
+    if paths:
+        text_a, text_b = (visible_text(Path(path).read_text()) for path in paths)
+    else:
+        text_a, text_b = synthetic_pair()
+
+    print(f'Comparing {len(text_a):,} and {len(text_b):,} characters')
+    for name, path in (('character', character_path), ('word', word_path)):
+        seconds = min(timeit.repeat(lambda: path(text_a, text_b), number=1, repeat=3))
+        removed, added = count_terms(path(text_a, text_b))
+        print(f'{name:>10}: {seconds:8.3f}s  '
+              f'({len(removed):,} removed terms, {len(added):,} added terms)')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (1, 3):
+        print(__doc__, file=sys.stderr)
+        sys.exit(1)
+    main(sys.argv[1:])
@@ -1,18 +1,34 @@
-from collections import Counter
-from contextlib import contextmanager
+from collections import Counter, OrderedDict
+from contextlib import ExitStack, contextmanager
 import concurrent.futures
+from itertools import islice
 import json
+import math
 import os.path
-import re
+import queue
+import resource
 import sys
+import threading
+import time
+import zlib
 from tqdm import tqdm
 from urllib.parse import urlparse
 from web_monitoring import db
 from web_monitoring.diff import differs
-from .sqlite import sqlite_database, write_page_to_sqlite
+from .sqlite import (PageDatabase, record_page_in_sqlite, sqlite_database,
+                     write_page_to_sqlite)
+from .columnar import ColumnarWriter
+from .chunking import chunked_diff, context_words
+from .extractors import get_extractor
+from .hosts import backoff_delay, configure_hosts
+from .matcher import KeyTermMatcher, load_terms
 from .terms import KEY_TERMS
-from .tools import (CharacterToWordDiffs, changed_ngrams, load_url,
-                    load_url_readability, parallel)
+from .text_cache import TextCache
+from .timing import Timings
+from .tools import (PARALLEL_THREADS, CharacterToWordDiffs, TooManyWordsError,
+                    WordEncoder, count_changed_ngrams, load_url, net_change,
+                    parallel, split_word_diff, tokenize, visible_text,
+                    word_level_diff)
 
 
 # Can Analyze? ----------------------------------------------------------------
@@ -118,8 +134,13 @@ def assert_can_analyze(page):
 
 # Analysis! -------------------------------------------------------------------
 
-def calculate_percent_changed(diff):
-    total_size = 0
+def calculate_percent_changed(diff, unchanged_size=0):
+    """
+    Get the fraction of the text in a diff that changed. `unchanged_size` is
+    the size of any unchanged text that was left out of the diff (see
+    `chunked_diff()`).
+    """
+    total_size = unchanged_size
     changed_size = 0
     for operation, text in diff:
         total_size += len(text)
@@ -132,45 +153,428 @@ def calculate_percent_changed(diff):
     return changed_size / total_size
 
 
-def analyze_page(page, grams):
+def version_body_key(version):
+    """
+    Get a key that identifies the body of a version. Versions with the same
+    body have the same key.
+    """
+    return version.get('body_hash') or version['uuid']
+
+
+# Texts recently loaded in this process, so versions that show up on several
+# pages (e.g. redirects or identical error pages) are only loaded once. Texts
+# are kept until they add up to more than this many characters.
+RECENT_TEXTS_SIZE = 4_000_000
+_recent_texts = OrderedDict()
+
+
+def version_text_key(version, kind):
+    """
+    Get the key to cache the text of a version with. Texts are cached by the
+    hash of the version's body (or its ID if there's no hash) and by `kind`,
+    the kind of text that was extracted.
+    """
+    return f'{kind}:{version_body_key(version)}'
+
+
+def cached_version_text(key, text_cache=None):
+    """
+    Get a tuple of whether a version's text is cached (in this process or the
+    text cache) and the text.
+    """
+    if key in _recent_texts:
+        _recent_texts.move_to_end(key)
+        return True, _recent_texts[key]
+    elif text_cache is not None:
+        found, text = text_cache.get(key)
+        if found:
+            remember_version_text(key, text)
+        return found, text
+    return False, None
+
+
+def remember_version_text(key, text):
+    if text is not None and len(text) > RECENT_TEXTS_SIZE:
+        return
+    _recent_texts[key] = text
+    size = sum(len(value) for value in _recent_texts.values() if value is not None)
+    while size > RECENT_TEXTS_SIZE:
+        _, oldest = _recent_texts.popitem(last=False)
+        if oldest is not None:
+            size -= len(oldest)
+
+
+# Words of texts recently tokenized in this process, so the same text isn't
+# tokenized again for the precheck and the diff, or for another page with a
+# version that has the same body. Texts are kept until they add up to more
+# than this many characters.
+RECENT_TOKENS_SIZE = 4_000_000
+_recent_tokens = OrderedDict()
+
+
+def cached_tokenize(text):
+    """
+    Same as `tokenize()`, but reuses the words of texts that were tokenized
+    recently in this process. Don't modify the returned list.
+    """
+    words = _recent_tokens.get(text)
+    if words is not None:
+        _recent_tokens.move_to_end(text)
+        return words
+
+    words = tokenize(text)
+    if len(text) <= RECENT_TOKENS_SIZE:
+        _recent_tokens[text] = words
+        size = sum(map(len, _recent_tokens))
+        while size > RECENT_TOKENS_SIZE:
+            oldest, _ = _recent_tokens.popitem(last=False)
+            size -= len(oldest)
+    return words
+
+
+def load_version_text(version, kind, load, text_cache=None):
+    """
+    Load the text of a version with `load(version)`, using the text cache if
+    there is one (see `version_text_key()`).
+    """
+    key = version_text_key(version, kind)
+    found, text = cached_version_text(key, text_cache)
+    if found:
+        return text
+
+    text = load(version)
+    if text_cache is not None:
+        text_cache.set(key, text)
+    remember_version_text(key, text)
+    return text
+
+
+def load_main_texts(versions, extractor, load_body, text_cache=None, timings=None):
+    """
+    Load the main content text of a set of versions with an extractor (see
+    `extractors.py`), using the text cache if there is one. The bodies of any
+    versions that aren't cached are loaded in parallel with `load_body()`, then
+    sent to the extractor all at once.
+
+    If `timings` is a `Timings` object, the time spent extracting is recorded
+    in it.
+    """
+    if timings is None:
+        timings = Timings()
+    keys = [version_text_key(version, extractor.name) for version in versions]
+    texts = []
+    missing = []
+    for index, key in enumerate(keys):
+        found, text = cached_version_text(key, text_cache)
+        texts.append(text)
+        if not found:
+            missing.append(index)
+
+    if missing:
+        bodies = parallel(*((load_body, versions[index]) for index in missing))
+        with timings.stage(extractor.name, size=sum(map(len, bodies))):
+            extracted = extractor.extract_many([(body, versions[index]['capture_url'])
+                                                for index, body in zip(missing, bodies)])
+        for index, text in zip(missing, extracted):
+            texts[index] = text
+            if text_cache is not None:
+                text_cache.set(keys[index], text)
+            remember_version_text(keys[index], text)
+
+    return texts
+
+
+class BodyLoader:
+    """
+    Loads the raw bodies of versions (as text), fetching each one at most once
+    until it's forgotten with `forget()`. Call it with a version to get its
+    body.
+    """
+
+    def __init__(self, timings):
+        self.timings = timings
+        self.bodies = {}
+
+    def __call__(self, version):
+        if version['uuid'] not in self.bodies:
+            with self.timings.stage('fetch') as stage:
+                response = load_url(version['uri'])
+                stage.size = len(response.content)
+            self.bodies[version['uuid']] = response.text
+        return self.bodies[version['uuid']]
+
+    def forget(self, version):
+        self.bodies.pop(version['uuid'], None)
+
+    def visible_text(self, version, text_cache=None):
+        """
+        Get the visible text of a version's body (see `visible_text()`), using
+        the text cache if there is one.
+        """
+        def load_visible(version):
+            body = self(version)
+            with self.timings.stage('extract', size=len(body)):
+                return visible_text(body)
+
+        return load_version_text(version, 'visible', load_visible, text_cache)
+
+
+def load_texts(versions, text_cache=None, timings=None, extractor='readability'):
+    """
+    Load the text to compare for each of a set of versions. The main content
+    of each version is found with the extractor named `extractor` (see
+    `extractors.py`). If any one of them couldn't be parsed, fall back to the
+    straight HTML text for *all* of them (we want what we're diffing to
+    conceptually match up).
+
+    The raw body of each version is fetched at most once, and all the bodies
+    are passed to the extractor together (e.g. in one request to the
+    readability server), so the fallback doesn't need to fetch anything again.
+
+    If `timings` is a `Timings` object, the time spent fetching and parsing
+    is recorded in it.
+    """
+    if timings is None:
+        timings = Timings()
+    extractor = get_extractor(extractor)
+    load_body = BodyLoader(timings)
+
+    texts = load_main_texts(versions, extractor, load_body, text_cache, timings)
+    if any(text is None for text in texts):
+        texts = parallel(*((load_body.visible_text, version, text_cache)
+                           for version in versions))
+    return texts
+
+
+# Pages whose texts (both versions together) are longer than this many
+# characters are diffed in chunks (see `analyze_page()`).
+LARGE_DOCUMENT_SIZE = 1_000_000
+
+
+def analyze_page(page, grams=2, diff_mode='character', text_cache=None,
+                 texts=None, key_term_matcher=None, timings=None,
+                 extractor='readability',
+                 large_document_size=LARGE_DOCUMENT_SIZE):
     """
     Analyze a page from web-monitoring-db and return information about how the
     words on it changed between the first and latest captured versions.
+
+    `diff_mode` can be `'character'` to diff the texts character-by-character
+    and recompose the results into words, or `'word'` to tokenize the texts
+    and diff the words directly (much faster on large pages).
+
+    If `text_cache` is a `TextCache`, the extracted text of each version is
+    read from and saved to it. If `texts` is set, it should be the already
+    loaded text of the earliest and latest versions (see `fetch_page()`).
+
+    If `key_term_matcher` is a `KeyTermMatcher`, only the changes to its terms
+    are counted, instead of every n-gram up to `grams` words long.
+
+    If `timings` is a `Timings` object, the time spent in each stage of the
+    analysis is recorded in it.
+
+    `extractor` is the name of the extractor to get the main text of each
+    version with (see `extractors.py`).
+
+    If the texts of both versions together are longer than
+    `large_document_size` characters, they're diffed in chunks to limit memory
+    use (see `chunking.py`). Set it to None to always diff the whole texts.
     """
     assert_can_analyze(page)
+    if timings is None:
+        timings = Timings()
 
-    version_first = page['earliest']
-    version_last = page['latest']
+    if texts is None:
+        texts = load_texts((page['earliest'], page['latest']), text_cache,
+                           timings, extractor)
+    text_a, text_b = texts
+    text_size = len(text_a) + len(text_b)
+    elided_size = 0
 
-    response_a, response_b = parallel((load_url_readability, version_first['uri']),
-                                      (load_url_readability, version_last['uri']))
-    # load_url_text returns None if the content couldn't be parsed by
-    # readability. If either one of the original documents couldn't be parsed,
-    # fall back to straight HTML text for *both* (we want what we're diffing to
-    # conceptually match up).
-    if response_a and response_b:
-        text_a = response_a.text
-        text_b = response_b.text
-        raw_diff = differs.html_source_diff(text_a, text_b)
-    else:
-        response_a, response_b = parallel((load_url, version_first['uri']),
-                                          (load_url, version_last['uri']))
-        text_a = re.sub(r'[\s\r\n]+', ' ', response_a.text)
-        text_b = re.sub(r'[\s\r\n]+', ' ', response_b.text)
-        raw_diff = differs.html_text_diff(text_a, text_b)
-
-    # This script leverages our textual diffing routines, which work
-    # character-by-character, so we have to recompose the results into *words*.
-    # That's a little absurd, and we might be better off in the future to
-    # tokenize the words and diff them directly instead.
-    word_diff = CharacterToWordDiffs.word_diffs(raw_diff['diff'])
+    try:
+        if large_document_size and text_size > large_document_size:
+            with timings.stage('large_diff', size=text_size):
+                longest_term = (key_term_matcher.longest_term if key_term_matcher
+                                else grams)
+                raw_diff, elided_size = chunked_diff(
+                    text_a, text_b, diff_mode, context=context_words(longest_term))
+            with timings.stage('words', size=text_size):
+                if diff_mode == 'word':
+                    word_diff = split_word_diff(raw_diff)
+                else:
+                    word_diff = CharacterToWordDiffs.word_diffs(raw_diff)
+        elif diff_mode == 'word':
+            with timings.stage('diff', size=text_size):
+                raw_diff = word_level_diff(text_a, text_b, cached_tokenize)
+            with timings.stage('words', size=text_size):
+                word_diff = split_word_diff(raw_diff)
+        else:
+            # Our textual diffing routines work character-by-character, so we
+            # have to recompose the results into *words*. The 'word' mode
+            # above tokenizes first and diffs the words directly instead.
+            with timings.stage('diff', size=text_size):
+                raw_diff = differs.html_source_diff(text_a, text_b)['diff']
+            with timings.stage('words', size=text_size):
+                word_diff = CharacterToWordDiffs.word_diffs(raw_diff)
+    except TooManyWordsError as error:
+        # Some huge data listings have too many distinct words to diff.
+        raise AnalyzableError(str(error)) from error
 
     # Count the terms that were added and removed.
-    terms = (Counter(), Counter(),)
-    for gram in range(1, grams + 1):
-        terms[0].update(Counter(changed_ngrams(word_diff[0], gram)))
-        terms[1].update(Counter(changed_ngrams(word_diff[1], gram)))
+    with timings.stage('terms'):
+        if key_term_matcher:
+            terms = (key_term_matcher.count(word_diff[0]),
+                     key_term_matcher.count(word_diff[1]),)
+        else:
+            terms = (count_changed_ngrams(word_diff[0], grams),
+                     count_changed_ngrams(word_diff[1], grams),)
 
+    return {
+        **describe_page(page),
+        'percent_changed': calculate_percent_changed(raw_diff, elided_size),
+        'terms': terms,
+    }
+
+
+# How many versions `analyze_page_history()` loads at a time.
+HISTORY_BATCH_SIZE = 5
+
+
+def analyze_page_history(page, grams=2, text_cache=None, key_term_matcher=None,
+                         timings=None, versions=None, extractor='readability'):
+    """
+    Analyze every version of a page from web-monitoring-db in order, instead
+    of just the earliest and latest, so terms that were removed and later
+    restored (or added and later removed) are counted. Each consecutive pair of
+    versions is diffed word-by-word.
+
+    Returns the same information as `analyze_page()`, where `terms` are the
+    totals for all the changes, plus a `history` list with the net change to
+    each term (see `net_change()`) between each pair of versions that changed.
+
+    `versions` is the list of the page's versions, oldest first. If it's not
+    set, it's loaded from web-monitoring-db (see `list_versions()`). Versions
+    with the same body as the one before are skipped without loading them.
+    The rest are loaded `HISTORY_BATCH_SIZE` at a time, and only the words of
+    the version before are kept while diffing, so memory use doesn't grow with
+    the length of the history. If the main content of either version in a
+    pair couldn't be parsed, that pair is compared by its straight HTML text
+    instead (see `load_texts()`).
+
+    The other options are the same as for `analyze_page()`.
+    """
+    assert_can_analyze(page)
+    if timings is None:
+        timings = Timings()
+
+    if versions is None:
+        with timings.stage('metadata'):
+            versions = list(list_versions(page['uuid']))
+
+    # Only keep versions where the body changed from the one before.
+    changed_versions = []
+    for version in versions:
+        if not is_fetchable(version['uri']) or not is_analyzable_media(version):
+            continue
+        if changed_versions and version_body_key(changed_versions[-1]) == version_body_key(version):
+            continue
+        changed_versions.append(version)
+
+    if len(changed_versions) < 2:
+        raise AnalyzableError('Page has only one version with analyzable content')
+
+    extractor = get_extractor(extractor)
+    load_body = BodyLoader(timings)
+
+    def words(text):
+        with timings.stage('tokenize', size=len(text)):
+            return cached_tokenize(text)
+
+    def load_batch(batch):
+        """
+        Get a dict for each version with the words of its main text (or None if
+        it couldn't be parsed).
+        """
+        texts = load_main_texts(batch, extractor, load_body, text_cache, timings)
+        return [{'version': version,
+                 'main_words': words(text) if text is not None else None,
+                 'visible_words': None}
+                for version, text in zip(batch, texts)]
+
+    def visible_words(loaded):
+        if loaded['visible_words'] is None:
+            loaded['visible_words'] = words(load_body.visible_text(loaded['version'], text_cache))
+        return loaded['visible_words']
+
+    removed = Counter()
+    added = Counter()
+    total_size = 0
+    changed_size = 0
+    history = []
+    previous = None
+    for start in range(0, len(changed_versions), HISTORY_BATCH_SIZE):
+        for current in load_batch(changed_versions[start:start + HISTORY_BATCH_SIZE]):
+            if previous is None:
+                previous = current
+                continue
+
+            if previous['main_words'] is not None and current['main_words'] is not None:
+                words_a, words_b = previous['main_words'], current['main_words']
+            else:
+                words_a, words_b = visible_words(previous), visible_words(current)
+
+            with timings.stage('diff', size=len(words_a) + len(words_b)):
+                encoder = WordEncoder()
+                try:
+                    raw_diff = encoder.diff(encoder.encode(words_a), encoder.encode(words_b))
+                except TooManyWordsError as error:
+                    raise AnalyzableError(str(error)) from error
+            with timings.stage('words'):
+                word_diff = split_word_diff(raw_diff)
+
+            with timings.stage('terms'):
+                if key_term_matcher:
+                    terms = (key_term_matcher.count(word_diff[0]),
+                             key_term_matcher.count(word_diff[1]),)
+                else:
+                    terms = (count_changed_ngrams(word_diff[0], grams),
+                             count_changed_ngrams(word_diff[1], grams),)
+            removed.update(terms[0])
+            added.update(terms[1])
+
+            version_a = previous['version']
+            version_b = current['version']
+            pair_size = sum(len(word) for _, word in raw_diff)
+            pair_changed = sum(len(word) for operation, word in raw_diff if operation != 0)
+            total_size += pair_size
+            changed_size += pair_changed
+            net_terms = net_change(*terms)
+            if net_terms:
+                history.append({
+                    'from_id': version_a['uuid'],
+                    'to_id': version_b['uuid'],
+                    'from_date': version_a['capture_time'].isoformat() + 'Z',
+                    'to_date': version_b['capture_time'].isoformat() + 'Z',
+                    'percent_changed': pair_size and pair_changed / pair_size,
+                    'terms': dict(net_terms),
+                })
+
+            # The earlier version isn't needed anymore.
+            load_body.forget(version_a)
+            previous = current
+
+    return {
+        **describe_page(page),
+        'percent_changed': total_size and changed_size / total_size,
+        'terms': (removed, added),
+        'history': history,
+    }
+
+
+def describe_page(page):
+    """Get the page and version metadata that goes in an analysis result."""
+    version_first = page['earliest']
+    version_last = page['latest']
     return {
         'id': page['uuid'],
         'first_id': version_first['uuid'],
@@ -180,45 +584,338 @@ def analyze_page(page, grams):
         'status': version_last['status'],
         'first_date': version_first['capture_time'].isoformat() + 'Z',
         'last_date': version_last['capture_time'].isoformat() + 'Z',
-        'percent_changed': calculate_percent_changed(raw_diff['diff']),
-        'terms': terms,
     }
 
 
-def process_page(page, grams=2):
+# Keys of the metadata from `describe_page()`.
+PAGE_KEYS = frozenset(('id', 'first_id', 'last_id', 'url', 'title', 'status',
+                       'first_date', 'last_date'))
+
+
+class UnchangedPage:
+    """
+    The result for a page that was found to have no changes before it was
+    diffed, either because both versions have the same body (`BODY`) or the
+    same words once their text is normalized (`TEXT`). This is falsy, like the
+    `None` result for pages that had no changes after diffing.
+    """
+
+    BODY = 'body'
+    TEXT = 'text'
+
+    def __init__(self, reason):
+        self.reason = reason
+
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return f'UnchangedPage({self.reason!r})'
+
+
+def bodies_match(page):
+    """
+    Check whether the earliest and latest versions of a page have the same
+    body, according to their hashes in web-monitoring-db.
+    """
+    return version_body_key(page['earliest']) == version_body_key(page['latest'])
+
+
+def texts_match(text_a, text_b):
+    """
+    Check whether two texts have the same words once they're normalized (see
+    `tokenize()`), in which case diffing them won't find any changed terms.
+    """
+    return text_a == text_b or cached_tokenize(text_a) == cached_tokenize(text_b)
+
+
+def process_page(page, history=False, **options):
     """
     In-process wrapper for analyze_page() that handles exceptions because
     Python multiprocessing seems to have issues with actual raised exceptions.
+    Returns a tuple of the result and a `Timings` object for the page.
+
+    If `history` is true, every version of the page is analyzed with
+    `analyze_page_history()` (which always diffs word-by-word). Otherwise, the
+    result is an `UnchangedPage` if the versions are found to be the same
+    before diffing them.
     """
+    timings = Timings()
     try:
-        analyzed = analyze_page(page, grams)
+        with timings.stage('analysis'):
+            if history:
+                options.pop('diff_mode', None)
+                options.pop('large_document_size', None)
+                analyzed = analyze_page_history(page, timings=timings, **options)
+            else:
+                assert_can_analyze(page)
+                texts = options.pop('texts', None)
+                if texts is None:
+                    if bodies_match(page):
+                        return UnchangedPage(UnchangedPage.BODY), timings
+                    texts = load_texts((page['earliest'], page['latest']),
+                                       options.get('text_cache'), timings,
+                                       options.get('extractor', 'readability'))
+
+                with timings.stage('precheck', size=len(texts[0]) + len(texts[1])):
+                    same_text = texts_match(*texts)
+                if same_text:
+                    return UnchangedPage(UnchangedPage.TEXT), timings
+
+                analyzed = analyze_page(page, texts=texts, timings=timings, **options)
         # Percent changed can be > 0 even when no words changed if only
         # whitespace changed. Not ideal, but oh well.
         if analyzed['percent_changed'] > 0 and (len(analyzed['terms'][0]) > 0 or len(analyzed['terms'][1]) > 0):
-            return analyzed
+            return analyzed, timings
         else:
-            return None
+            return None, timings
+    except Exception as error:
+        error.page_id = page['uuid']
+        return error, timings
+    finally:
+        timings.record_peak_memory()
+
+
+def fetch_page(page, text_cache=None, extractor='readability'):
+    """
+    Load the texts to compare for a page, for use as a separate I/O stage
+    before `analyze_page()`. Like `process_page()`, this returns exceptions
+    instead of raising them, and returns a tuple of the result and a `Timings`
+    object for the page.
+    """
+    timings = Timings()
+    try:
+        assert_can_analyze(page)
+        if bodies_match(page):
+            return UnchangedPage(UnchangedPage.BODY), timings
+        texts = load_texts((page['earliest'], page['latest']), text_cache,
+                           timings, extractor)
+        return texts, timings
     except Exception as error:
         error.page_id = page['uuid']
-        return error
+        return error, timings
 
 
-def analyze_pages(pages, grams=2, parallel=10):
+def analyze_pages(pages, parallel=10, max_in_flight=None, dedupe=True,
+                  stats=None, fetch_threads=0, timings=None, host_rate=None,
+                  worker_memory_limit=None, **options):
     """
-    Analyze a set of pages in parallel across multiple processes. Yields the
-    result of analyzing each page, which may be:
+    Analyze a set of pages in parallel across multiple processes. Yields a
+    tuple of each page and the result of analyzing it, which may be:
     - A dict (analysis result)
     - An exception
-    - None (page could not be analyzed and was skipped)
+    - None (the page had no textual changes)
+
+    Keyword arguments other than the ones below are passed on to
+    `analyze_page()`.
+
+    Pages are read from `pages` lazily, and at most `max_in_flight` (default:
+    4 × `parallel` + `fetch_threads`) are being worked on at a time, so memory
+    use stays flat no matter how many pages there are.
+
+    If `fetch_threads` is set, the texts for each page are loaded by a pool of
+    that many threads in this process, and then handed to the worker processes
+    for analysis. That way, the worker processes only do CPU-bound work and
+    aren't tied up waiting on the network.
+
+    If `host_rate` is set, at most that many requests per second are made to
+    each archive host, split evenly between whichever processes are loading
+    versions. Either way, the number of simultaneous requests to each host
+    adapts to how quickly it responds (see `hosts.py`).
+
+    If `worker_memory_limit` is set, each worker process can use at most that
+    many megabytes of data memory, not counting thread stacks (see
+    `initialize_worker()`). It should be at least `MIN_WORKER_MEMORY_LIMIT`.
+    Pages that need more fail with a `MemoryError` instead of exhausting the
+    machine's memory.
+
+    If `dedupe` is true, pages whose earliest and latest versions have the same
+    bodies as a page that was already analyzed reuse that page's results
+    instead of being analyzed again. Pass a `Counter` as `stats` to count how
+    many pages were deduplicated.
+
+    If `timings` is a `Timings` object, the timings of each stage of analysis
+    from all the worker processes are added to it, and each analysis result
+    dict gets a `timings` key with the seconds spent on each stage for it.
     """
-    with concurrent.futures.ProcessPoolExecutor(max_workers=parallel) as executor:
-        analyses = (executor.submit(process_page, page, grams) for page in pages)
-        for item in concurrent.futures.as_completed(analyses):
-            yield item.result()
+    if max_in_flight is None:
+        max_in_flight = 4 * parallel + fetch_threads
+    if stats is None:
+        stats = Counter()
+
+    pages = iter(pages)
+    # Maps the key of each page being analyzed to other pages with the same
+    # content that are waiting for its results. Waiting pages count toward
+    # `max_in_flight`, too.
+    waiting = {}
+    waiting_count = 0
+    # Recent results by key (see `compact_analysis()`), for pages whose
+    # duplicates come later.
+    analyzed = OrderedDict()
+
+    with ExitStack() as stack:
+        # Page metadata may still be loading (with a request cache installed)
+        # in another thread when worker processes are forked, so make sure
+        # workers don't inherit the cache.
+        worker_rate = None
+        if host_rate and not fetch_threads:
+            worker_rate = host_rate / parallel
+        executor = stack.enter_context(concurrent.futures.ProcessPoolExecutor(
+            max_workers=parallel,
+            initializer=initialize_worker,
+            initargs=(worker_rate, worker_memory_limit)))
+        fetcher = None
+        if fetch_threads:
+            configure_hosts(rate=host_rate)
+            fetcher = stack.enter_context(concurrent.futures.ThreadPoolExecutor(
+                max_workers=fetch_threads))
+
+        # Maps futures for both fetching and analysis to their pages.
+        in_flight = {}
+        fetching = set()
+        # Timings from the fetch stage for pages that are now being analyzed.
+        fetch_timings = {}
+
+        def submit(page):
+            if fetcher:
+                future = fetcher.submit(fetch_page, page, options.get('text_cache'),
+                                        options.get('extractor', 'readability'))
+                fetching.add(future)
+            else:
+                future = executor.submit(process_page, page, **options)
+            in_flight[future] = page
+
+        def finish(page, result):
+            nonlocal waiting_count
+            yield page, result
+
+            if dedupe:
+                key = page_content_key(page)
+                duplicates = waiting.pop(key)
+                waiting_count -= len(duplicates)
+                if isinstance(result, Exception):
+                    # Failures may be temporary, so don't share them.
+                    # Analyze the next duplicate instead.
+                    if duplicates:
+                        waiting[key] = duplicates[1:]
+                        waiting_count += len(duplicates) - 1
+                        submit(duplicates[0])
+                else:
+                    analyzed[key] = compact_analysis(result)
+                    if len(analyzed) > DEDUPE_HISTORY_SIZE:
+                        analyzed.popitem(last=False)
+                    for duplicate in duplicates:
+                        stats['deduplicated'] += 1
+                        yield duplicate, copy_analysis(result, duplicate)
+
+        while True:
+            while len(in_flight) + waiting_count < max_in_flight:
+                page = next(pages, None)
+                if page is None:
+                    break
+                elif not dedupe:
+                    submit(page)
+                else:
+                    try:
+                        assert_can_analyze(page)
+                    except AnalyzableError as error:
+                        error.page_id = page['uuid']
+                        yield page, error
+                        continue
+
+                    key = page_content_key(page)
+                    if key in analyzed:
+                        stats['deduplicated'] += 1
+                        yield page, copy_analysis(analyzed[key], page)
+                    elif key in waiting:
+                        waiting[key].append(page)
+                        waiting_count += 1
+                    else:
+                        waiting[key] = []
+                        submit(page)
+
+            if not in_flight:
+                break
+
+            done, _ = concurrent.futures.wait(
+                in_flight,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for item in done:
+                page = in_flight.pop(item)
+                result, page_timings = item.result()
+                if item in fetching:
+                    fetching.remove(item)
+                    if not isinstance(result, (Exception, UnchangedPage)):
+                        future = executor.submit(process_page, page, texts=result, **options)
+                        in_flight[future] = page
+                        fetch_timings[future] = page_timings
+                        continue
+                elif item in fetch_timings:
+                    page_timings.merge(fetch_timings.pop(item))
+
+                if timings is not None:
+                    timings.merge(page_timings)
+                    if isinstance(result, dict):
+                        result['timings'] = page_timings.totals()
+
+                yield from finish(page, result)
+
+
+# How many recent results to keep around for deduplicating pages.
+DEDUPE_HISTORY_SIZE = 1000
+
+
+def page_content_key(page):
+    """
+    Get a key that identifies the content being compared for a page. Pages with
+    the same key will have the same analysis results.
+    """
+    return (version_body_key(page['earliest']),
+            version_body_key(page['latest']))
+
+
+def copy_analysis(result, page):
+    """
+    Make a copy of the analysis result of a page for another page with the
+    same content. `result` can also be a result from `compact_analysis()`.
+    """
+    if isinstance(result, bytes):
+        result = json.loads(zlib.decompress(result))
+        result['terms'] = tuple(map(Counter, result['terms']))
+    if not result:
+        return result
+    copy = {**result, **describe_page(page)}
+    copy.pop('timings', None)
+    return copy
+
+
+def compact_analysis(result):
+    """
+    Get a smaller copy of an analysis result to keep around for deduplicating
+    pages. Results with changes are reduced to the parts that are the same for
+    every page with the same content (not the page metadata or timings), and
+    compressed. Use `copy_analysis()` to get the full result for a page.
+    """
+    if not result:
+        return result
+    shared = {key: value for key, value in result.items()
+              if key not in PAGE_KEYS and key != 'timings'}
+    return zlib.compress(json.dumps(shared, separators=(',', ':')).encode('utf-8'))
 
 
 # Grabbing Data from the Web Monitoring Database ------------------------------
 
+def list_versions(page_id):
+    """List all the versions of a page from web-monitoring-db, oldest first."""
+    client = db.Client.from_env()
+    chunk = 1
+    while chunk > 0:
+        versions = client.list_versions(page_id=page_id, sort=['capture_time:asc'],
+                                        chunk=chunk, chunk_size=1000)
+        yield from versions['data']
+        chunk = versions['links']['next'] and (chunk + 1) or -1
+
+
 def get_page_count(url_pattern):
     client = db.Client.from_env()
     data = client.list_pages(chunk_size=1, url=url_pattern, active=True,
@@ -226,25 +923,155 @@ def get_page_count(url_pattern):
     return data['meta']['total_results']
 
 
-def list_all_pages(url_pattern):
-    client = db.Client.from_env()
-    chunk = 1
-    while chunk > 0:
-        pages = request_page_chunk(client, url_pattern, chunk)
-        yield from pages['data']
-        chunk = pages['links']['next'] and (chunk + 1) or -1
+# Number of pages to request from web-monitoring-db at a time.
+PAGE_CHUNK_SIZE = 1000
 
+# Clients for web-monitoring-db, one per thread.
+_clients = threading.local()
 
-def request_page_chunk(client, url_pattern, chunk=1, retries=2):
-    try:
-        return client.list_pages(sort=['created_at:asc'], chunk_size=1000,
-                                 chunk=chunk, url=url_pattern, active=True,
-                                 include_earliest=True, include_latest=True)
-    except Exception:
-        if retries > 0:
-            return request_page_chunk(url_pattern, chunk, retries - 1)
+
+def db_client():
+    """Get a web-monitoring-db client for the current thread."""
+    if getattr(_clients, 'client', None) is None:
+        _clients.client = db.Client.from_env()
+    return _clients.client
+
+
+def list_all_pages(url_pattern, timings=None, total=None, connections=4,
+                   ordered=True):
+    """
+    Load all the pages matching a URL pattern from web-monitoring-db. Chunks
+    of pages are requested concurrently over up to `connections` connections.
+
+    `total` is the number of pages there are (see `get_page_count()`), which
+    is used to figure out what chunks to request. If it's not set, it's loaded
+    first. If `ordered` is false, each chunk of pages is yielded as soon as it
+    arrives, instead of in order.
+    """
+    if timings is None:
+        timings = Timings()
+    if total is None:
+        total = get_page_count(url_pattern)
+
+    def load_chunk(chunk):
+        with timings.stage('metadata'):
+            return request_page_chunk(db_client(), url_pattern, chunk)
+
+    chunk_count = max(1, math.ceil(total / PAGE_CHUNK_SIZE))
+    chunks = iter(range(1, chunk_count + 1))
+    last_chunk = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
+        # Only request a few chunks ahead of what's been consumed.
+        in_flight = OrderedDict((executor.submit(load_chunk, chunk), chunk)
+                                for chunk in islice(chunks, 2 * connections))
+        while in_flight:
+            if ordered:
+                future = next(iter(in_flight))
+            else:
+                future = next(concurrent.futures.as_completed(in_flight))
+            chunk = in_flight.pop(future)
+            pages = future.result()
+            if chunk == chunk_count:
+                last_chunk = pages
+
+            for next_chunk in islice(chunks, 1):
+                in_flight[executor.submit(load_chunk, next_chunk)] = next_chunk
+            yield from pages['data']
+
+    # Pages may have been added since we got the total.
+    chunk = chunk_count + 1
+    while last_chunk and last_chunk['links']['next']:
+        last_chunk = load_chunk(chunk)
+        yield from last_chunk['data']
+        chunk += 1
+
+
+def stream_pages(url_pattern, cache=False, buffer_size=5000, timings=None,
+                 total=None, connections=4):
+    """
+    Load all the pages matching a URL pattern from web-monitoring-db in a
+    background thread and yield them as they arrive, so analysis can start
+    before all the metadata is loaded. At most `buffer_size` pages are held
+    waiting to be consumed; loading pauses while the buffer is full.
+
+    `total` and `connections` are passed on to `list_all_pages()`. Pages are
+    yielded as their chunks arrive, rather than in order.
+
+    If `timings` is a `Timings` object, the time spent loading each chunk of
+    pages is recorded in it.
+    """
+    buffer = queue.Queue(maxsize=buffer_size)
+    done = object()
+
+    def load_pages():
+        try:
+            with cached_requests(cache):
+                pages = list_all_pages(url_pattern, timings, total=total,
+                                       connections=connections, ordered=False)
+                for page in pages:
+                    buffer.put(page)
+        except Exception as error:
+            buffer.put(error)
+        finally:
+            buffer.put(done)
+
+    threading.Thread(target=load_pages, daemon=True).start()
+    while True:
+        page = buffer.get()
+        if page is done:
+            break
+        elif isinstance(page, Exception):
+            raise page
+        yield page
+
+
+def pages_needing_analysis(pages, analyzed_versions, stats):
+    """
+    Filter out pages whose latest version is the same as the one they were
+    last analyzed at. `analyzed_versions` is a dict of page IDs to version IDs
+    (see `PageDatabase.analyzed_versions()`), and filtered pages are counted in
+    `stats['up_to_date']`.
+    """
+    for page in pages:
+        latest = page['latest'] and page['latest']['uuid']
+        if analyzed_versions.get(page['uuid']) == latest:
+            stats['up_to_date'] += 1
+        else:
+            yield page
+
+
+def pages_not_recorded(pages, recorded, stats):
+    """
+    Filter out pages that are in `recorded` (a set of page IDs, see
+    `PageDatabase.recorded_pages()`), counting them in `stats['resumed']`.
+    """
+    for page in pages:
+        if page['uuid'] in recorded:
+            stats['resumed'] += 1
         else:
-            raise
+            yield page
+
+
+def pages_in(pages, page_ids):
+    """Filter out pages that aren't in the set `page_ids`."""
+    return (page for page in pages if page['uuid'] in page_ids)
+
+
+def request_page_chunk(client, url_pattern, chunk=1, retries=4, backoff=1):
+    """
+    Request a chunk of pages from web-monitoring-db, retrying up to `retries`
+    times if it fails. The maximum delay between retries starts at `backoff`
+    seconds and doubles each time (see `hosts.backoff_delay()`).
+    """
+    for attempt in range(retries + 1):
+        try:
+            return client.list_pages(sort=['created_at:asc'], chunk_size=PAGE_CHUNK_SIZE,
+                                     chunk=chunk, url=url_pattern, active=True,
+                                     include_earliest=True, include_latest=True)
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff_delay(attempt, base=backoff))
 
 
 # Output and Main Program -----------------------------------------------------
@@ -253,6 +1080,21 @@ def write_page_to_stdout(page):
     print(json.dumps(page, separators=(',', ':')))
 
 
+@contextmanager
+def output_writer(output_format='json', path=None):
+    """
+    Yield a function that writes an analysis result in the given format:
+    - `json` writes JSON lines to stdout.
+    - `columnar` writes the columnar format (see `columnar.py`) to a directory
+      at `path`.
+    """
+    if output_format == 'columnar':
+        with ColumnarWriter(path) as writer:
+            yield writer.write_page
+    else:
+        yield write_page_to_stdout
+
+
 def message(text):
     """
     Log a user-facing message to stderr (we print program output on stdout so
@@ -261,6 +1103,21 @@ def message(text):
     print(text, file=sys.stderr)
 
 
+def write_stats(path, timings, counts, elapsed):
+    """
+    Write a JSON file with the per-stage timings of a run (see
+    `Timings.summary()`), the number of pages in each outcome, the peak memory
+    of each worker process, and the total time the run took.
+    """
+    with open(path, 'w') as file:
+        json.dump({
+            'elapsed_seconds': elapsed,
+            'pages': counts,
+            'stages': timings.summary(),
+            'worker_peak_rss_bytes': timings.peak_memory,
+        }, file, indent=2)
+
+
 @contextmanager
 def cached_requests(enable, *args, **kwargs):
     """
@@ -278,33 +1135,166 @@ def cached_requests(enable, *args, **kwargs):
         requests_cache.uninstall_cache()
 
 
-def main(pattern=None, grams=2, sqlite_path=None, cache=False, verbose=False):
+def disable_cached_requests():
+    """
+    Make sure requests are not cached in this process, even if it was forked
+    from a process that was inside `cached_requests()`.
+    """
+    import requests_cache
+    requests_cache.uninstall_cache()
+
+
+# Smallest memory limit (in megabytes) for worker processes. A worker uses
+# about half this much for the code and libraries it imports before it
+# analyzes any pages.
+MIN_WORKER_MEMORY_LIMIT = 256
+
+# Stack size (in bytes) for threads in worker processes with a memory limit.
+WORKER_THREAD_STACK_SIZE = 2 * 1024 * 1024
+
+
+def initialize_worker(host_rate=None, memory_limit=None):
+    """
+    Set up a worker process for `analyze_pages()`. If `memory_limit` is set,
+    the process can allocate at most that many megabytes of data (its heap
+    and other private memory), plus the stacks of the threads it loads
+    versions with.
+    """
+    disable_cached_requests()
+    configure_hosts(rate=host_rate)
+    if memory_limit:
+        # RLIMIT_AS would also count address space that is reserved but never
+        # used (allocator arenas, mapped libraries), so workers would fail far
+        # below the limit. On Linux 4.7+, RLIMIT_DATA covers the heap and
+        # private mappings, which is what large pages use. Thread stacks are
+        # private mappings, too, and the default size (usually 8 MB) would
+        # use up much of the limit, so they're made smaller and added to it.
+        threading.stack_size(WORKER_THREAD_STACK_SIZE)
+        limit = (memory_limit * 1024 * 1024
+                 + (PARALLEL_THREADS + 1) * WORKER_THREAD_STACK_SIZE)
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+
+
+def main(pattern=None, grams=2, sqlite_path=None, cache=False, verbose=False,
+         diff_mode='character', workers=10, max_in_flight=None,
+         text_cache_path=None, text_cache_size=1024, dedupe=True,
+         fetch_threads=0, sqlite_batch_size=1000, incremental=False,
+         key_terms_path=None, key_terms_only=False, output_format='json',
+         output_path=None, stats_path=None, sqlite_timings=False,
+         history=False, metadata_connections=4, extractor='readability',
+         host_rate=None, resume=False, retry_failed=False,
+         large_document_size=LARGE_DOCUMENT_SIZE, worker_memory_limit=None):
+    start_time = time.perf_counter()
+    # Only collect timings if they're going to be reported somewhere.
+    timings = None
+    if stats_path or sqlite_timings:
+        timings = Timings()
+
     # Only cache this part -- the actual analysis work is multiprocess, and
     # will probably have major locking issues with the cache file :(
     with cached_requests(cache):
-        # Get metadata about pages and versions from web-monitoring-db
         total = get_page_count(pattern)
-        pages = list(tqdm(list_all_pages(pattern), desc='loading metadata', unit=' pages'))
 
-    with sqlite_database(sqlite_path) as database:
+    # Get metadata about pages and versions from web-monitoring-db, streaming
+    # it into the analysis as it loads.
+    pages = stream_pages(pattern, cache=cache, timings=timings, total=total,
+                         connections=metadata_connections)
+
+    matcher = KeyTermMatcher(load_terms(key_terms_path) if key_terms_path else KEY_TERMS)
+    key_terms = frozenset(matcher.terms)
+
+    text_cache = None
+    if text_cache_path:
+        text_cache = TextCache(text_cache_path, max_size=text_cache_size * 1024 * 1024)
+        cache_stats_before = text_cache.stats()
+
+    with output_writer(output_format, output_path) as write_page, \
+            sqlite_database(sqlite_path, batch_size=sqlite_batch_size,
+                            incremental=incremental,
+                            resume=resume or retry_failed) as database:
         unchanged = 0
         skipped = []
         failed = []
+        stats = Counter()
+        progress_total = total
+
+        if incremental and database:
+            pages = pages_needing_analysis(pages, database.analyzed_versions(), stats)
+        elif resume and database:
+            recorded = database.recorded_pages()
+            pages = pages_not_recorded(pages, recorded, stats)
+            progress_total = max(0, total - len(recorded))
+        elif retry_failed and database:
+            failed_ids = database.failed_pages()
+            message(f'Retrying {len(failed_ids)} pages that failed before.')
+            pages = pages_in(pages, failed_ids)
+            progress_total = len(failed_ids)
 
         # Actually analyze the pages and output the results.
-        for result in tqdm(analyze_pages(pages, grams), desc='analyzing', unit=' pages', total=total):
+        results = analyze_pages(pages, parallel=workers,
+                                max_in_flight=max_in_flight,
+                                # Pages with the same earliest and latest
+                                # versions can have different histories.
+                                dedupe=dedupe and not history,
+                                fetch_threads=fetch_threads,
+                                host_rate=host_rate,
+                                worker_memory_limit=worker_memory_limit,
+                                grams=grams,
+                                large_document_size=large_document_size,
+                                diff_mode=diff_mode,
+                                history=history,
+                                text_cache=text_cache,
+                                extractor=extractor,
+                                key_term_matcher=key_terms_only and matcher or None,
+                                stats=stats,
+                                timings=timings)
+        output_timings = timings or Timings()
+        for page, result in tqdm(results, desc='analyzing', unit=' pages', total=progress_total):
             if isinstance(result, AnalyzableError):
                 skipped.append(result)
+                record_page_in_sqlite(page, database, PageDatabase.SKIPPED, str(result))
             elif isinstance(result, Exception):
                 failed.append(result)
+                record_page_in_sqlite(page, database, PageDatabase.FAILED, str(result))
             elif result:
-                write_page_to_stdout(result)
-                write_page_to_sqlite(result, database, KEY_TERMS)
+                page_timings = result.pop('timings', None)
+                with output_timings.stage('output'):
+                    write_page(result)
+                with output_timings.stage('sqlite'):
+                    write_page_to_sqlite(result, database, key_terms,
+                                         timings=sqlite_timings and page_timings or None)
             else:
                 unchanged += 1
+                if isinstance(result, UnchangedPage):
+                    stats[f'unchanged_{result.reason}'] += 1
+                record_page_in_sqlite(page, database, PageDatabase.UNCHANGED)
+
+        if text_cache:
+            cache_stats = text_cache.stats()
+            hits = cache_stats['hits'] - cache_stats_before['hits']
+            misses = cache_stats['misses'] - cache_stats_before['misses']
+            evictions = cache_stats['evictions'] - cache_stats_before['evictions']
+            message(f'Text cache: {hits} hits, {misses} misses, {evictions} evictions '
+                    f'({cache_stats["size"] / 1024 / 1024:.1f} MB cached).')
+
+        if stats['up_to_date'] > 0:
+            message(f'{stats["up_to_date"]} pages were already analyzed at their '
+                    f'latest version and were not analyzed again.')
+
+        if stats['resumed'] > 0:
+            message(f'{stats["resumed"]} pages were already done in the run being '
+                    f'resumed and were not analyzed again.')
+
+        if stats['deduplicated'] > 0:
+            message(f'{stats["deduplicated"]} pages had the same content as another '
+                    f'page and reused its analysis.')
 
         if unchanged > 0:
             message(f'{unchanged} pages had no textual changes.')
+            if stats['unchanged_body'] > 0:
+                message(f'  {stats["unchanged_body"]} had identical bodies and were not loaded.')
+            if stats['unchanged_text'] > 0:
+                message(f'  {stats["unchanged_text"]} had the same words in both versions and were not diffed.')
 
         if len(skipped) > 0:
             message(f'{len(skipped)} pages could not be analyzed.')
@@ -317,3 +1307,12 @@ def main(pattern=None, grams=2, sqlite_path=None, cache=False, verbose=False):
             if verbose:
                 for page in failed:
                     message(f'  {page.page_id} ({page})')
+
+    if stats_path:
+        write_stats(stats_path, timings, {
+            'total': total,
+            'unchanged': unchanged,
+            'skipped': len(skipped),
+            'failed': len(failed),
+            **stats,
+        }, time.perf_counter() - start_time)
@@ -0,0 +1,229 @@
+"""
+Diffing for very large documents (e.g. multi-megabyte data listings), where
+diffing the whole texts at once and turning the result into words can take
+gigabytes of memory.
+
+`chunked_diff()` splits both texts into blocks (lines, sentences, or shorter
+runs of words), and anchors them on blocks that appear exactly once in each
+text and are in the same order (like "patience diff"). Only the chunks
+between anchors are actually diffed, so each diff is small. Long runs of
+unchanged text are cut down to the few words on either side of a change, since
+those are the only unchanged words that can be part of a changed term.
+
+Examples
+--------
+>>> diff, elided_size = chunked_diff(text_a, text_b, 'word')
+>>> calculate_percent_changed(diff, unchanged_size=elided_size)
+"""
+from bisect import bisect_left
+from collections import Counter
+import re
+import zlib
+from web_monitoring.diff import differs
+from .tools import tokenize, word_level_diff
+
+
+# Blocks end at line breaks and at the ends of sentences.
+BLOCK_END = re.compile(r'(?<=[.!?])\s+|\s*\n\s*')
+
+# Blocks longer than this (in characters) are split further at words chosen
+# by their content, so the split points are the same in both texts no matter
+# what comes before them. On average, every `CONTENT_BOUNDARY_WORDS`th word
+# ends a block. Words are picked by CRC rather than `hash()`, which is salted
+# differently in each process, so the blocks (and results) are reproducible.
+MAX_BLOCK_SIZE = 2000
+CONTENT_BOUNDARY_WORDS = 32
+WORD = re.compile(r'\S+\s*')
+
+# Chunks (both sides together, in characters) bigger than this are diffed
+# word-by-word, even in character mode.
+MAX_CHUNK_SIZE = 200_000
+
+# Unchanged words to keep on each side of a change. This needs to be at least
+# one less than the longest term being counted (see `context_words()`).
+CONTEXT_WORDS = 10
+
+# Stands in for unchanged text that was left out. It's a stopword (see
+# `tools.STOPWORDS`), so no term is counted across it.
+ELIDED_TEXT = 'the'
+
+
+def context_words(longest_term):
+    """
+    Get how many unchanged words to keep on each side of a change so that
+    every changed term up to `longest_term` words long is still counted.
+    """
+    return max(CONTEXT_WORDS, longest_term - 1)
+
+
+def split_blocks(text):
+    """
+    Split text into blocks that end with whitespace (or the end of the text),
+    so no word is split between blocks. Joining the blocks gives the original
+    text.
+    """
+    blocks = []
+    start = 0
+    for match in BLOCK_END.finditer(text):
+        if match.end() > start:
+            _add_block(blocks, text[start:match.end()])
+            start = match.end()
+    if start < len(text):
+        _add_block(blocks, text[start:])
+    return blocks
+
+
+def _add_block(blocks, block):
+    if len(block) <= MAX_BLOCK_SIZE:
+        blocks.append(block)
+        return
+
+    start = 0
+    for match in WORD.finditer(block):
+        word = match.group().rstrip()
+        if zlib.crc32(word.encode()) % CONTENT_BOUNDARY_WORDS == 0 or match.end() - start >= MAX_BLOCK_SIZE:
+            blocks.append(block[start:match.end()])
+            start = match.end()
+    if start < len(block):
+        blocks.append(block[start:])
+
+
+def find_anchors(blocks_a, blocks_b):
+    """
+    Find the longest sequence of blocks that appear exactly once in each list,
+    in the same order in both. Returns a list of `(index_a, index_b)` tuples.
+    """
+    counts_a = Counter(blocks_a)
+    counts_b = Counter(blocks_b)
+    unique_b = {block: index for index, block in enumerate(blocks_b)
+                if counts_b[block] == 1}
+    pairs = [(index, unique_b[block]) for index, block in enumerate(blocks_a)
+             if counts_a[block] == 1 and block in unique_b]
+
+    # Longest increasing subsequence of the indexes in B (patience sorting).
+    # `tails[n]` is the index in `pairs` of the smallest B index that ends an
+    # increasing run of length n + 1.
+    tails = []
+    tail_values = []
+    previous = [None] * len(pairs)
+    for pair_index, (_, index_b) in enumerate(pairs):
+        position = bisect_left(tail_values, index_b)
+        if position > 0:
+            previous[pair_index] = tails[position - 1]
+        if position == len(tails):
+            tails.append(pair_index)
+            tail_values.append(index_b)
+        else:
+            tails[position] = pair_index
+            tail_values[position] = index_b
+
+    anchors = []
+    pair_index = tails[-1] if tails else None
+    while pair_index is not None:
+        anchors.append(pairs[pair_index])
+        pair_index = previous[pair_index]
+    anchors.reverse()
+    return anchors
+
+
+def aligned_chunks(text_a, text_b):
+    """
+    Align two texts on their unique blocks. Yields `(text_a, text_b)` tuples
+    of the chunks between anchors, where each pair of chunks is either equal
+    (and unchanged) or needs to be diffed.
+    """
+    blocks_a = split_blocks(text_a)
+    blocks_b = split_blocks(text_b)
+    start_a = start_b = 0
+    equal = []
+    for end_a, end_b in find_anchors(blocks_a, blocks_b) + [(len(blocks_a), len(blocks_b))]:
+        # Blocks that match at the start or end of a gap are unchanged, too.
+        while start_a < end_a and start_b < end_b and blocks_a[start_a] == blocks_b[start_b]:
+            equal.append(blocks_a[start_a])
+            start_a += 1
+            start_b += 1
+        trailing = []
+        while end_a > start_a and end_b > start_b and blocks_a[end_a - 1] == blocks_b[end_b - 1]:
+            end_a -= 1
+            end_b -= 1
+            trailing.append(blocks_a[end_a])
+
+        if start_a < end_a or start_b < end_b:
+            if equal:
+                text = ''.join(equal)
+                yield text, text
+                equal = []
+            yield ''.join(blocks_a[start_a:end_a]), ''.join(blocks_b[start_b:end_b])
+
+        equal.extend(reversed(trailing))
+        # The anchor itself (there isn't one after the last gap).
+        if end_a + len(trailing) < len(blocks_a):
+            equal.append(blocks_a[end_a + len(trailing)])
+        start_a = end_a + len(trailing) + 1
+        start_b = end_b + len(trailing) + 1
+
+    if equal:
+        text = ''.join(equal)
+        yield text, text
+
+
+def chunked_diff(text_a, text_b, diff_mode='character', context=CONTEXT_WORDS):
+    """
+    Diff two large texts chunk by chunk (see `aligned_chunks()`). Returns a
+    tuple of the diff, in the same format `analyze_page()` gets for
+    `diff_mode`, and the size of the unchanged text that was left out of it.
+
+    Unchanged runs of more than twice `context` words are cut down to
+    `context` words at each end, separated by `ELIDED_TEXT`. Pass the left out
+    size to `calculate_percent_changed()` to account for it.
+    """
+    diff = []
+    elided_size = 0
+    for chunk_a, chunk_b in aligned_chunks(text_a, text_b):
+        if chunk_a == chunk_b:
+            if diff_mode == 'word':
+                elided_size += _add_unchanged_words(diff, tokenize(chunk_a), context)
+            else:
+                elided_size += _add_unchanged_text(diff, chunk_a, context)
+        elif diff_mode == 'word':
+            diff.extend(word_level_diff(chunk_a, chunk_b))
+        elif not chunk_a or not chunk_b:
+            diff.append((-1, chunk_a) if chunk_a else (1, chunk_b))
+        elif len(chunk_a) + len(chunk_b) > MAX_CHUNK_SIZE:
+            # Keep the words separate, so they aren't run together when the
+            # character diff is converted to words.
+            diff.extend((operation, f'{word} ')
+                        for operation, word in word_level_diff(chunk_a, chunk_b))
+        else:
+            diff.extend(differs.html_source_diff(chunk_a, chunk_b)['diff'])
+    return diff, elided_size
+
+
+def _add_unchanged_words(diff, words, context):
+    if len(words) <= 2 * context + 1:
+        diff.extend((0, word) for word in words)
+        return 0
+
+    diff.extend((0, word) for word in words[:context])
+    diff.append((0, ELIDED_TEXT))
+    diff.extend((0, word) for word in words[-context:])
+    return sum(len(word) for word in words[context:-context]) - len(ELIDED_TEXT)
+
+
+def _add_unchanged_text(diff, text, context):
+    # Split on whitespace to find where the first and last `context` words
+    # end and start. The remaining parts have their surrounding whitespace
+    # stripped, so their lengths give the offsets.
+    head = text.split(None, context)
+    tail = text.rsplit(None, context)
+    head_end = len(text) - len(head[-1])
+    tail_start = len(tail[0])
+    if (len(head) <= context or len(tail) <= context
+            or tail_start - head_end <= len(ELIDED_TEXT) + 2):
+        diff.append((0, text))
+        return 0
+
+    diff.append((0, text[:head_end]))
+    diff.append((0, f' {ELIDED_TEXT} '))
+    diff.append((0, text[tail_start:]))
+    return tail_start - head_end - len(ELIDED_TEXT) - 2
@@ -0,0 +1,154 @@
+"""
+A compact, columnar file format for analysis results. Results are written to a
+directory with:
+
+- `meta.json`: the format version and number of pages and terms.
+- `terms.txt`: every term in the results, one per line. A term's ID is its
+  line number (starting from 0).
+- `pages.jsonl`: metadata for each page (everything but the terms), one JSON
+  object per line.
+- `offsets.u64`: where each page's terms start and end in the next two
+  columns. The terms removed from page `n` are at `offsets[2n]` up to
+  `offsets[2n + 1]`, and the terms added are at `offsets[2n + 1]` up to
+  `offsets[2n + 2]`.
+- `term_ids.u32`: the ID of each removed or added term.
+- `counts.u32`: how many times each removed or added term was removed or
+  added.
+
+The `.u64` and `.u32` files are raw, little-endian arrays of unsigned 64 and 32
+bit integers, so they can be memory-mapped and scanned without parsing, e.g.
+with `numpy.memmap(path, dtype='<u4', mode='r')`.
+"""
+from array import array
+import json
+import mmap
+from pathlib import Path
+import sys
+
+
+FORMAT_VERSION = 1
+
+
+def _write_array(file, type_code, values):
+    values = array(type_code, values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    values.tofile(file)
+
+
+class ColumnarWriter:
+    """
+    Write analysis results to a directory in the columnar format. Pages are
+    written as they come in, so only the term dictionary is kept in memory.
+
+    Examples
+    --------
+    >>> with ColumnarWriter('results') as writer:
+    ...     for result in results:
+    ...         writer.write_page(result)
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.term_ids = {}
+        self.page_count = 0
+        self._offset = 0
+        self._files = {}
+
+    def __enter__(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._files = {
+            'terms': open(self.path / 'terms.txt', 'w', encoding='utf-8'),
+            'pages': open(self.path / 'pages.jsonl', 'w', encoding='utf-8'),
+            'offsets': open(self.path / 'offsets.u64', 'wb'),
+            'term_ids': open(self.path / 'term_ids.u32', 'wb'),
+            'counts': open(self.path / 'counts.u32', 'wb'),
+        }
+        _write_array(self._files['offsets'], 'Q', [0])
+        return self
+
+    def __exit__(self, *args):
+        for file in self._files.values():
+            file.close()
+        with open(self.path / 'meta.json', 'w') as file:
+            json.dump({'version': FORMAT_VERSION,
+                       'pages': self.page_count,
+                       'terms': len(self.term_ids)},
+                      file)
+
+    def term_id(self, term):
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            term_id = self.term_ids[term] = len(self.term_ids)
+            self._files['terms'].write(f'{term}\n')
+        return term_id
+
+    def write_page(self, page):
+        metadata = {key: value for key, value in page.items() if key != 'terms'}
+        self._files['pages'].write(json.dumps(metadata, separators=(',', ':')))
+        self._files['pages'].write('\n')
+
+        offsets = []
+        for terms in page['terms']:
+            _write_array(self._files['term_ids'], 'I',
+                         (self.term_id(term) for term in terms.keys()))
+            _write_array(self._files['counts'], 'I', terms.values())
+            self._offset += len(terms)
+            offsets.append(self._offset)
+        _write_array(self._files['offsets'], 'Q', offsets)
+        self.page_count += 1
+
+
+class ColumnarReader:
+    """
+    Read analysis results from a directory in the columnar format. The
+    `offsets`, `term_ids`, and `counts` columns are memory-mapped and
+    available as `memoryview` objects.
+
+    Examples
+    --------
+    >>> results = ColumnarReader('results')
+    >>> for page, (removed, added) in results.pages():
+    ...     print(page['url'], removed, added)
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / 'meta.json') as file:
+            self.meta = json.load(file)
+        if self.meta['version'] != FORMAT_VERSION:
+            raise ValueError(f'Unsupported columnar format version: {self.meta["version"]}')
+        if sys.byteorder == 'big':
+            raise ValueError('Reading columnar results is not supported on big-endian systems')
+
+        self.offsets = self._map('offsets.u64', 'Q')
+        self.term_ids = self._map('term_ids.u32', 'I')
+        self.counts = self._map('counts.u32', 'I')
+
+    def _map(self, name, type_code):
+        with open(self.path / name, 'rb') as file:
+            if file.seek(0, 2) == 0:
+                return memoryview(b'').cast(type_code)
+            return memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)).cast(type_code)
+
+    def terms(self):
+        """Load the list of all terms, indexed by term ID."""
+        with open(self.path / 'terms.txt', encoding='utf-8') as file:
+            return [line[:-1] for line in file]
+
+    def pages(self, terms=None):
+        """
+        Yield a tuple of each page's metadata and its terms, as a tuple of
+        `{term: count}` dicts for removed and added terms (like the `terms` in
+        the JSON output).
+        """
+        if terms is None:
+            terms = self.terms()
+
+        with open(self.path / 'pages.jsonl', encoding='utf-8') as file:
+            for index, line in enumerate(file):
+                yield json.loads(line), tuple(
+                    {terms[self.term_ids[position]]: self.counts[position]
+                     for position in range(self.offsets[2 * index + direction],
+                                           self.offsets[2 * index + direction + 1])}
+                    for direction in (0, 1))
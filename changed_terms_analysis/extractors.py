@@ -0,0 +1,262 @@
+"""
+Ways to get the main content text out of a version's HTML, so changes to
+headers, footers, navigation, etc. aren't counted.
+
+Each extractor has a `name` (used to select it, and to key its results in the
+text cache) and an `extract(html, url)` method that returns the main text of a
+page, or None if it couldn't find any. `extract_many(documents)` does the same
+for a list of `(html, url)` tuples at once. `get_extractor()` gets an
+extractor by name:
+
+- `readability` sends the HTML to the readability server (see the
+  `readability-server` directory), which needs to be running separately.
+- `lxml` finds the main content in-process, with a simplified version of
+  readability's heuristics. It's less accurate, but doesn't need Node or any
+  network requests, so it scales with the number of worker processes.
+"""
+from abc import ABC, abstractmethod
+import re
+import html5_parser
+from lxml import etree
+from .tools import parse_readability, parse_readability_batch
+
+
+class Extractor(ABC):
+    """Base class for text extractors."""
+
+    name = None
+
+    @abstractmethod
+    def extract(self, html, url):
+        ...
+
+    def extract_many(self, documents):
+        return [self.extract(html, url) for html, url in documents]
+
+
+class ReadabilityServerExtractor(Extractor):
+    """
+    Extract text with the readability server. `extract_many()` sends all the
+    documents in a single request.
+    """
+
+    name = 'readability'
+
+    def extract(self, html, url):
+        parsed = parse_readability(html, url)
+        return parsed['text'] if parsed else None
+
+    def extract_many(self, documents):
+        results = parse_readability_batch([{'html': html, 'url': url}
+                                           for html, url in documents])
+        return [parsed['text'] if parsed else None for parsed in results]
+
+
+# Elements that are never part of the main content.
+BOILERPLATE_TAGS = frozenset(('aside', 'button', 'footer', 'form', 'header',
+                              'iframe', 'menu', 'nav', 'noscript', 'object',
+                              'script', 'select', 'style', 'svg', 'template'))
+
+# IDs and classes of elements that are probably not part of the main content,
+# unless they also look like content.
+UNLIKELY_CANDIDATE = re.compile(
+    r'banner|breadcrumb|combx|comment|community|cookie|disqus|footer|'
+    r'header|menu|modal|nav|popup|promo|related|remark|rss|share|'
+    r'shoutbox|sidebar|skip|social|sponsor|tool|utility', re.I)
+MAYBE_CANDIDATE = re.compile(r'and|article|body|column|content|main|shadow', re.I)
+
+# Elements whose text counts toward their ancestors' content scores.
+SCORED_TAGS = frozenset(('p', 'pre', 'td', 'li', 'dd', 'blockquote'))
+
+# Elements whose text should be separated from the text around them.
+BLOCK_TAGS = frozenset(('address', 'article', 'blockquote', 'br', 'dd', 'div',
+                        'dl', 'dt', 'figcaption', 'figure', 'h1', 'h2', 'h3',
+                        'h4', 'h5', 'h6', 'hr', 'li', 'main', 'ol', 'p', 'pre',
+                        'section', 'table', 'td', 'th', 'tr', 'ul'))
+
+# Paragraphs shorter than this aren't scored.
+MIN_PARAGRAPH_LENGTH = 25
+
+# A `<main>` or `<article>` element with at least this much text is used as
+# the main content without scoring.
+MIN_LANDMARK_LENGTH = 200
+
+WHITESPACE = re.compile(r'\s+')
+
+
+def parse_html(html):
+    return html5_parser.parse(html, treebuilder='lxml')
+
+
+def element_text(element):
+    """Get the text of an element, with whitespace collapsed."""
+    return WHITESPACE.sub(' ', etree.tostring(element, method='text',
+                                              encoding='unicode')).strip()
+
+
+def _span(text):
+    """
+    Get a tuple of the length of a string with whitespace collapsed, and
+    whether it starts and ends with whitespace.
+    """
+    if not text:
+        return (0, False, False)
+    collapsed = WHITESPACE.sub(' ', text)
+    return (len(collapsed), collapsed[0] == ' ', collapsed[-1] == ' ')
+
+
+def _join_spans(a, b):
+    """Get the span (see `_span()`) of two strings joined together."""
+    if not a[0]:
+        return b
+    if not b[0]:
+        return a
+    # Whitespace at the end of one and the start of the other is collapsed.
+    return (a[0] + b[0] - (a[2] and b[1]), a[1], b[2])
+
+
+class TextStats:
+    """
+    The length of the text of each element in a tree (the same as the length
+    of `element_text()`), how many commas are in it, and how much of it is in
+    links. These are all computed in one pass up the tree, instead of getting
+    the text of each element separately, which would go over nested elements'
+    text again for each of their ancestors.
+    """
+
+    def __init__(self, root):
+        # Like `element_text()`, each element's text includes its tail.
+        self.spans = {}
+        self.commas = {}
+        self.link_lengths = {}
+        # Children come after their parents, so go in reverse.
+        for element in reversed(list(root.iter())):
+            span = (0, False, False)
+            commas = 0
+            link_length = 0
+            # Comments and processing instructions only have their tails.
+            if isinstance(element.tag, str):
+                span = _span(element.text)
+                commas = element.text.count(',') if element.text else 0
+                for child in element:
+                    span = _join_spans(span, self.spans[child])
+                    commas += self.commas[child]
+                    link_length += self.link_lengths[child]
+            span = _join_spans(span, _span(element.tail))
+            commas += element.tail.count(',') if element.tail else 0
+            self.spans[element] = span
+            self.commas[element] = commas
+            if element.tag == 'a':
+                link_length += self.text_length(element)
+            self.link_lengths[element] = link_length
+
+    def text_length(self, element):
+        length, leading, trailing = self.spans[element]
+        # `element_text()` strips whitespace from the ends.
+        return max(0, length - leading - trailing)
+
+    def link_density(self, element):
+        text_length = self.text_length(element)
+        if not text_length:
+            return 0
+        return self.link_lengths[element] / text_length
+
+
+class ContentExtractor(Extractor):
+    """
+    Extract the main content of a page in-process. Boilerplate elements are
+    removed, then the element containing the most substantial paragraphs of
+    text is picked as the main content, similar to readability.
+    """
+
+    name = 'lxml'
+
+    def extract(self, html, url=None):
+        root = parse_html(html)
+        self.remove_boilerplate(root)
+        stats = TextStats(root)
+        candidate = self.find_landmark(root, stats)
+        if candidate is None:
+            candidate = self.find_best_candidate(root, stats)
+        if candidate is None:
+            return None
+
+        for element in candidate.iter(*BLOCK_TAGS):
+            element.text = ' ' + (element.text or '')
+            element.tail = ' ' + (element.tail or '')
+        return element_text(candidate) or None
+
+    def remove_boilerplate(self, root):
+        doomed = []
+        for element in root.iter():
+            if not isinstance(element.tag, str):
+                continue
+            if element.tag in BOILERPLATE_TAGS:
+                doomed.append(element)
+            elif element.tag not in ('html', 'body', 'main', 'article'):
+                names = f'{element.get("id", "")} {element.get("class", "")}'
+                if (UNLIKELY_CANDIDATE.search(names) and
+                        not MAYBE_CANDIDATE.search(names)):
+                    doomed.append(element)
+
+        for element in doomed:
+            parent = element.getparent()
+            # Ancestors may already have been removed.
+            if parent is not None:
+                # Keep the text that follows the element.
+                previous = element.getprevious()
+                if element.tail:
+                    if previous is not None:
+                        previous.tail = (previous.tail or '') + ' ' + element.tail
+                    else:
+                        parent.text = (parent.text or '') + ' ' + element.tail
+                parent.remove(element)
+
+    def find_landmark(self, root, stats):
+        landmarks = [element for element in root.iter('main', 'article')
+                     if stats.text_length(element) >= MIN_LANDMARK_LENGTH]
+        landmarks.extend(element for element in root.xpath('//*[@role="main"]')
+                         if stats.text_length(element) >= MIN_LANDMARK_LENGTH)
+        if landmarks:
+            return max(landmarks, key=stats.text_length)
+        return None
+
+    def find_best_candidate(self, root, stats):
+        scores = {}
+        for paragraph in root.iter(*SCORED_TAGS):
+            text_length = stats.text_length(paragraph)
+            if text_length < MIN_PARAGRAPH_LENGTH:
+                continue
+
+            score = 1 + stats.commas[paragraph] + min(text_length // 100, 3)
+            parent = paragraph.getparent()
+            if parent is None:
+                continue
+            scores[parent] = scores.get(parent, 0) + score
+            grandparent = parent.getparent()
+            if grandparent is not None:
+                scores[grandparent] = scores.get(grandparent, 0) + score / 2
+
+        best = None
+        best_score = 0
+        for element, score in scores.items():
+            score *= 1 - stats.link_density(element)
+            if score > best_score:
+                best, best_score = element, score
+
+        if best is None:
+            body = root.find('body')
+            return body if body is not None and stats.text_length(body) else None
+        return best
+
+
+EXTRACTORS = {extractor.name: extractor
+              for extractor in (ReadabilityServerExtractor, ContentExtractor)}
+
+
+def get_extractor(name):
+    """Get an instance of the extractor with a given name."""
+    try:
+        return EXTRACTORS[name]()
+    except KeyError:
+        raise ValueError(f'Unknown extractor: {name!r}') from None
@@ -1,4 +1,7 @@
 # Extra Bits that were left out of the ultimate script, but might be useful.
+from collections import Counter
+
+
 class IntersectionCounter(Counter):
     """
     Like a counter, but when you update it, it only considers what's in common.
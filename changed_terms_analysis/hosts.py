@@ -0,0 +1,292 @@
+"""
+Per-host limits on HTTP requests, so we can fetch as fast as a host allows
+without getting throttled or piling up retries when it's struggling.
+
+Each host gets a `HostPolicy` (per process) made of:
+
+- A `TokenBucket` limiting requests per second (if a rate is configured).
+- An `AdaptiveLimit` on simultaneous requests. It grows by about one request
+  for every round of successful requests and is cut in half when the host
+  errors, throttles us, or slows down a lot (AIMD, like TCP congestion
+  control).
+- A `CircuitBreaker` that stops sending requests to a host for a while after
+  it fails many times in a row, so pages fail fast instead of tying up
+  workers with retries that won't succeed.
+
+Examples
+--------
+>>> policy = host_policy('https://example.com/some/page')
+>>> trial = policy.check()
+>>> with policy.slot():
+...     ...  # Make the request
+...     policy.record(latency=0.2, ok=True, trial=trial)
+"""
+import os
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+
+# Most simultaneous requests to any one host from a process.
+MAX_CONNECTIONS_PER_HOST = 10
+
+# Simultaneous requests to a host before we know anything about it.
+INITIAL_CONNECTIONS_PER_HOST = 4
+
+# A request that takes this many times longer than usual for its host counts
+# as a sign the host is overloaded.
+SLOW_REQUEST_FACTOR = 4
+
+# Consecutive failures before a host's circuit breaker opens, and how long (in
+# seconds) it stays open at first. The time doubles each time a trial request
+# fails, up to `MAX_OPEN_TIME`.
+FAILURE_THRESHOLD = 10
+OPEN_TIME = 30
+MAX_OPEN_TIME = 300
+
+
+class HostUnavailableError(Exception):
+    """Raised instead of making a request to a host whose circuit is open."""
+
+
+def backoff_delay(attempt, base=1, cap=60):
+    """
+    Get how long to wait before retry number `attempt` (starting at 0), with
+    exponential backoff and "full jitter", so clients that failed at the same
+    time don't all retry at the same time.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class TokenBucket:
+    """
+    Limit an action to `rate` times per second on average, allowing bursts of
+    up to `burst` at once.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until the action is allowed."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst,
+                                   self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveLimit:
+    """
+    A limit on simultaneous requests that adjusts itself with additive
+    increase/multiplicative decrease. Each successful request raises the limit
+    by `1 / limit` (so about one more request per round of requests), and each
+    error, throttled response, or unusually slow response halves it. The limit
+    is only cut once per `decrease_interval` seconds, so a burst of failures
+    from requests that were all in flight together only counts once.
+    """
+
+    def __init__(self, initial=INITIAL_CONNECTIONS_PER_HOST, minimum=1,
+                 maximum=MAX_CONNECTIONS_PER_HOST, decrease_interval=1):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.decrease_interval = decrease_interval
+        self.active = 0
+        # Smoothed latency of successful requests, in seconds.
+        self.latency = None
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.active >= int(self.limit):
+                self._condition.wait()
+            self.active += 1
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def record(self, latency, ok):
+        """Adjust the limit based on how a request went."""
+        with self._condition:
+            slow = (ok and self.latency is not None
+                    and latency > SLOW_REQUEST_FACTOR * self.latency)
+            if ok:
+                self.latency = (latency if self.latency is None
+                                else 0.9 * self.latency + 0.1 * latency)
+
+            if ok and not slow:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self._condition.notify_all()
+            else:
+                now = time.monotonic()
+                if now - self._last_decrease >= self.decrease_interval:
+                    self._last_decrease = now
+                    self.limit = max(self.minimum, self.limit / 2)
+
+
+class CircuitBreaker:
+    """
+    Track consecutive failures for a host. After `threshold` of them, the
+    circuit "opens" and `allow()` returns false for `open_time` seconds. After
+    that, one trial request is allowed through: if it succeeds, the circuit
+    closes again; if it fails, it stays open for twice as long. Results of
+    other requests that were already in flight don't end the trial.
+    """
+
+    def __init__(self, threshold=FAILURE_THRESHOLD, open_time=OPEN_TIME,
+                 max_open_time=MAX_OPEN_TIME):
+        self.threshold = threshold
+        self.base_open_time = open_time
+        self.max_open_time = max_open_time
+        self.open_time = open_time
+        self.failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Get whether a request is allowed: False if the circuit is open, or
+        `CircuitBreaker.TRIAL` if it's the trial request (which should be
+        passed to `record()` with its result).
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if (not self._trial_running
+                    and time.monotonic() - self._opened_at >= self.open_time):
+                self._trial_running = True
+                return self.TRIAL
+            return False
+
+    # Truthy value from `allow()` for the trial request.
+    TRIAL = 'trial'
+
+    def record(self, ok, trial=False):
+        with self._lock:
+            if trial:
+                self._trial_running = False
+            if ok:
+                # A request that started before the circuit opened can't
+                # close it; only the trial can.
+                if trial or self._opened_at is None:
+                    self.failures = 0
+                    self.open_time = self.base_open_time
+                    self._opened_at = None
+            else:
+                self.failures += 1
+                if trial:
+                    self.open_time = min(self.max_open_time, self.open_time * 2)
+                    self._opened_at = time.monotonic()
+                elif self._opened_at is None and self.failures >= self.threshold:
+                    self._opened_at = time.monotonic()
+
+
+class HostPolicy:
+    """The rate limit, concurrency limit, and circuit breaker for a host."""
+
+    def __init__(self, host, rate=None, max_connections=MAX_CONNECTIONS_PER_HOST):
+        self.host = host
+        self.bucket = TokenBucket(rate) if rate else None
+        self.concurrency = AdaptiveLimit(maximum=max_connections)
+        self.breaker = CircuitBreaker()
+
+    def check(self):
+        """
+        Raise `HostUnavailableError` if requests to the host are blocked.
+        Returns whether the request is the circuit breaker's trial, to pass to
+        `record()`.
+        """
+        allowed = self.breaker.allow()
+        if not allowed:
+            raise HostUnavailableError(f'{self.host} failed {self.breaker.failures} '
+                                       f'times in a row; not sending more requests for now')
+        return allowed == CircuitBreaker.TRIAL
+
+    def slot(self, rate_limited=True):
+        """
+        Get a context manager that waits until a request to the host is
+        allowed, and holds a spot in its concurrency limit while the request
+        is made.
+        """
+        if rate_limited and self.bucket:
+            self.bucket.acquire()
+        return _Slot(self.concurrency)
+
+    def record(self, latency, ok, trial=False):
+        self.concurrency.record(latency, ok)
+        self.breaker.record(ok, trial)
+
+    def timeout(self, minimum):
+        """
+        Get a read timeout for a request to the host: `minimum` seconds, or
+        longer if the host has been slow, so we don't give up on (and then
+        retry) requests to a host that is just busy.
+        """
+        latency = self.concurrency.latency
+        if latency is None:
+            return minimum
+        return min(4 * minimum, max(minimum, SLOW_REQUEST_FACTOR * latency))
+
+
+class _Slot:
+    def __init__(self, limit):
+        self.limit = limit
+
+    def __enter__(self):
+        self.limit.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.limit.release()
+
+
+_rate = None
+_max_connections = MAX_CONNECTIONS_PER_HOST
+_policies = {}
+_policies_pid = None
+_policies_lock = threading.Lock()
+
+
+def configure_hosts(rate=None, max_connections=MAX_CONNECTIONS_PER_HOST):
+    """
+    Set the limits for hosts in this process: at most `rate` requests per
+    second to each host (or no limit if None) and at most `max_connections`
+    simultaneous requests to each host. Only affects hosts that haven't been
+    requested yet.
+    """
+    global _rate, _max_connections
+    _rate = rate
+    _max_connections = max_connections
+
+
+def host_policy(url):
+    """Get the `HostPolicy` for the host of a URL in this process."""
+    global _policies, _policies_pid
+    host = urlparse(url).netloc
+    with _policies_lock:
+        # Locks held by other threads when the process was forked would never
+        # be released, so each process starts fresh.
+        if _policies_pid != os.getpid():
+            _policies = {}
+            _policies_pid = os.getpid()
+        policy = _policies.get(host)
+        if policy is None:
+            policy = _policies[host] = HostPolicy(host, _rate, _max_connections)
+        return policy
+
@@ -0,0 +1,117 @@
+from collections import Counter, deque
+from .tools import STOPWORDS, tokenize
+
+
+def normalize_term(term):
+    """
+    Normalize a term the same way words in a diff are normalized, so it can be
+    compared with n-grams from `changed_ngrams()`.
+
+    Examples
+    --------
+    >>> normalize_term('Cost-Effective')
+    'cost effective'
+    """
+    return ' '.join(tokenize(term))
+
+
+def load_terms(path):
+    """Read a list of terms from a file with one term per line."""
+    with open(path) as file:
+        return [line.strip() for line in file if line.strip()]
+
+
+class KeyTermMatcher:
+    """
+    Counts changed occurrences of a fixed set of terms in a word diff, without
+    enumerating every n-gram. The terms are compiled into an Aho–Corasick
+    automaton over word IDs, which is run over the words of a diff in a single
+    pass.
+
+    An occurrence is counted if any of its words changed, and (like
+    `changed_ngrams()`) occurrences can't span stopwords, so the results match
+    filtering `count_changed_ngrams()` down to the same terms.
+
+    Examples
+    --------
+    >>> matcher = KeyTermMatcher(['climate', 'climate change'])
+    >>> matcher.count([(0, 'climate'), (1, 'change'), (0, 'is'), (1, 'climate')])
+    Counter({'climate change': 1, 'climate': 1})
+    """
+
+    def __init__(self, terms):
+        self.terms = sorted(set(normalize_term(term) for term in terms) - {''})
+        self.word_ids = {}
+        # Number of words in the longest term.
+        self.longest_term = 0
+
+        # Each state has a dict of transitions by word ID, a failure link, and
+        # a list of (term, length) tuples that end at that state.
+        self._transitions = [{}]
+        self._failures = [0]
+        self._outputs = [[]]
+
+        for term in self.terms:
+            words = term.split(' ')
+            state = 0
+            for word in words:
+                word_id = self.word_ids.setdefault(word, len(self.word_ids))
+                next_state = self._transitions[state].get(word_id)
+                if next_state is None:
+                    next_state = len(self._transitions)
+                    self._transitions.append({})
+                    self._failures.append(0)
+                    self._outputs.append([])
+                    self._transitions[state][word_id] = next_state
+                state = next_state
+            self._outputs[state].append((term, len(words)))
+            self.longest_term = max(self.longest_term, len(words))
+
+        # Breadth-first, so the failure link of each state's parent is known.
+        queue = deque(self._transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for word_id, next_state in self._transitions[state].items():
+                queue.append(next_state)
+                failure = self._failures[state]
+                while failure and word_id not in self._transitions[failure]:
+                    failure = self._failures[failure]
+                failure = self._transitions[failure].get(word_id, 0)
+                if failure == next_state:
+                    failure = 0
+                self._failures[next_state] = failure
+                self._outputs[next_state] = (self._outputs[next_state] +
+                                             self._outputs[failure])
+
+    def count(self, diff, counter=None):
+        """
+        Count the changed occurrences of each term in a word diff (e.g. one of
+        the items from `CharacterToWordDiffs.word_diffs()`). If `counter` is
+        set, counts are added to it. Returns the counter.
+        """
+        if counter is None:
+            counter = Counter()
+
+        transitions = self._transitions
+        failures = self._failures
+        outputs = self._outputs
+        state = 0
+        last_change = -1
+        for index, (change, word) in enumerate(diff):
+            if change:
+                last_change = index
+
+            word_id = self.word_ids.get(word)
+            if word_id is None or word in STOPWORDS:
+                state = 0
+                continue
+
+            while state and word_id not in transitions[state]:
+                state = failures[state]
+            state = transitions[state].get(word_id, 0)
+
+            for term, length in outputs[state]:
+                if last_change > index - length:
+                    counter[term] += 1
+
+        return counter
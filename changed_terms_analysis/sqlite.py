@@ -1,25 +1,52 @@
 from contextlib import contextmanager
+import json
 from pathlib import Path
 import sqlite3
+import time
 from .tools import net_change
 
 
 @contextmanager
-def sqlite_database(db_path):
+def sqlite_database(db_path, batch_size=1000, incremental=False, resume=False):
+    """
+    Create a new SQLite database for analysis results at `db_path` and yield a
+    `PageDatabase` for writing to it (or None if `db_path` is None).
+
+    The database is set up for bulk loading: pages are committed in batches of
+    `batch_size` (or at least every `COMMIT_INTERVAL` seconds), writes aren't
+    synced to disk while loading, and secondary indexes are only built once
+    all the pages have been written. If the run is interrupted by an error,
+    the pages that were already done are still committed.
+
+    If `incremental` is true and there's already a database at `db_path`, it
+    is kept and updated instead of being replaced. If `resume` is true, an
+    existing database is kept so an interrupted run can pick up where it left
+    off (see `PageDatabase.recorded_pages()`).
+    """
     if db_path is None:
         yield None
         return
 
     db_path = Path(db_path)
-    if db_path.exists():
+    incremental = incremental and db_path.exists()
+    resume = resume and db_path.exists()
+    if db_path.exists() and not incremental and not resume:
         db_path.unlink()
 
     connection = sqlite3.connect(db_path)
     cursor = connection.cursor()
+    # Databases written before terms had their own table stored the text of
+    # each term in `term_changes`. Move that table aside so the new one can be
+    # created, and copy the changes over below.
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(term_changes)")]
+    if 'term' in columns:
+        cursor.execute("ALTER TABLE term_changes RENAME TO old_term_changes")
     cursor.executescript("""
         PRAGMA foreign_keys = ON;
+        PRAGMA journal_mode = WAL;
+        PRAGMA synchronous = OFF;
 
-        CREATE TABLE pages (
+        CREATE TABLE IF NOT EXISTS pages (
             id TEXT NOT NULL PRIMARY KEY,
             first_version_id TEXT NOT NULL,
             last_version_id TEXT NOT NULL,
@@ -29,55 +56,252 @@ def sqlite_database(db_path):
             status INTEGER,
             first_version_date TEXT NOT NULL,
             last_version_date TEXT NOT NULL,
-            percent_changed INTEGER NOT NULL
+            percent_changed INTEGER NOT NULL,
+            -- JSON object with the seconds spent on each stage of analysis.
+            timings TEXT
         );
 
-        CREATE UNIQUE INDEX pages_page_id ON pages (id);
-        CREATE INDEX pages_percent_changed ON pages (percent_changed);
-        CREATE INDEX pages_url ON pages (url COLLATE NOCASE);
-        CREATE INDEX pages_title ON pages (title COLLATE NOCASE);
+        CREATE TABLE IF NOT EXISTS terms (
+            id INTEGER NOT NULL PRIMARY KEY,
+            term TEXT NOT NULL
+        );
 
-        CREATE TABLE term_changes (
+        CREATE TABLE IF NOT EXISTS term_changes (
             page_id TEXT NOT NULL,
-            term TEXT NOT NULL,
+            term_id INTEGER NOT NULL,
             change_count INTEGER NOT NULL,
-            FOREIGN KEY(page_id) REFERENCES pages(id)
+            FOREIGN KEY(page_id) REFERENCES pages(id),
+            FOREIGN KEY(term_id) REFERENCES terms(id)
         );
 
-        CREATE UNIQUE INDEX term_changes_key ON term_changes (page_id, term);
-        CREATE INDEX term_changes_term ON term_changes (term);
-        CREATE INDEX term_changes_change_count ON term_changes (change_count);
+        -- Term changes with the actual text of each term, for easier querying.
+        CREATE VIEW IF NOT EXISTS term_changes_with_terms AS
+            SELECT term_changes.page_id, terms.term, term_changes.change_count
+            FROM term_changes JOIN terms ON terms.id = term_changes.term_id;
+
+        -- Every page that was analyzed (including ones with no changes, that
+        -- couldn't be analyzed, or that failed) and the latest version at the
+        -- time, so later runs can tell which pages need to be analyzed again.
+        CREATE TABLE IF NOT EXISTS analyzed_pages (
+            page_id TEXT NOT NULL PRIMARY KEY,
+            last_version_id TEXT NOT NULL,
+            status TEXT NOT NULL,
+            reason TEXT
+        );
     """)
+    # Databases written before the `timings` column was added need it added.
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(pages)")]
+    if 'timings' not in columns:
+        cursor.execute("ALTER TABLE pages ADD COLUMN timings TEXT")
+    tables = {row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if 'old_term_changes' in tables:
+        migrate_term_changes(cursor)
     cursor.close()
+    database = PageDatabase(connection, batch_size=batch_size,
+                            incremental=incremental)
+    if resume:
+        database.remove_unrecorded_pages()
     try:
-        yield connection
-        connection.commit()
+        yield database
+        database.finish()
+    except BaseException:
+        # Keep what was done so far, so the run can be resumed.
+        database.commit()
+        raise
     finally:
         connection.close()
 
 
-def write_page_to_sqlite(page, db=None, key_terms=None):
+def migrate_term_changes(cursor):
+    """
+    Copy term changes from an `old_term_changes` table, where each row has the
+    text of its term, to `term_changes`, where terms are referenced by ID, and
+    remove the old table.
+    """
+    cursor.executescript("""
+        BEGIN;
+        INSERT INTO terms (term)
+            SELECT DISTINCT term FROM old_term_changes
+            WHERE term NOT IN (SELECT term FROM terms);
+        CREATE UNIQUE INDEX IF NOT EXISTS terms_term ON terms (term);
+        INSERT INTO term_changes
+            SELECT old_term_changes.page_id, terms.id, old_term_changes.change_count
+            FROM old_term_changes JOIN terms ON terms.term = old_term_changes.term;
+        DROP TABLE old_term_changes;
+        COMMIT;
+    """)
+
+
+# Commit at least this often (in seconds), so an interrupted run loses little.
+COMMIT_INTERVAL = 30
+
+
+class PageDatabase:
+    """
+    Writes analyzed pages to a SQLite database created by `sqlite_database()`.
+    Terms are stored once in the `terms` table, and referenced by ID from the
+    `term_changes` table.
+    """
+
+    # Values for the `status` column of `analyzed_pages`.
+    CHANGED = 'changed'
+    UNCHANGED = 'unchanged'
+    SKIPPED = 'skipped'
+    FAILED = 'failed'
+
+    def __init__(self, connection, batch_size=1000, incremental=False):
+        self.connection = connection
+        self.batch_size = batch_size
+        self.incremental = incremental
+        self.term_ids = dict(connection.execute("SELECT term, id FROM terms"))
+        self._next_term_id = max(self.term_ids.values(), default=0) + 1
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
+
+    def analyzed_versions(self):
+        """
+        Get a dict of page IDs to the latest version that was analyzed for
+        each page, not including pages that failed.
+        """
+        return dict(self.connection.execute(
+            "SELECT page_id, last_version_id FROM analyzed_pages WHERE status != ?",
+            (self.FAILED,)))
+
+    def recorded_pages(self):
+        """
+        Get a set of the IDs of all the pages recorded in the database,
+        whatever their outcome.
+        """
+        return {row[0] for row in self.connection.execute(
+            "SELECT page_id FROM analyzed_pages")}
+
+    def failed_pages(self):
+        """Get a set of the IDs of pages that failed to be analyzed."""
+        return {row[0] for row in self.connection.execute(
+            "SELECT page_id FROM analyzed_pages WHERE status = ?", (self.FAILED,))}
+
+    def remove_unrecorded_pages(self):
+        """
+        Remove results for pages that aren't in `analyzed_pages`. A page is
+        only recorded there once all its results are written, so these are
+        left over from a run that stopped in the middle of writing a page.
+        """
+        self.connection.executescript("""
+            DELETE FROM term_changes
+                WHERE page_id NOT IN (SELECT page_id FROM analyzed_pages);
+            DELETE FROM pages
+                WHERE id NOT IN (SELECT page_id FROM analyzed_pages);
+        """)
+        self.commit()
+
+    def record_page(self, page_id, last_version_id, status, reason=None):
+        """
+        Record the outcome of analyzing a page, removing any earlier results
+        for it if it didn't change.
+        """
+        if status != self.CHANGED:
+            self._remove_page(page_id)
+
+        self.connection.execute(
+            "INSERT OR REPLACE INTO analyzed_pages VALUES (?, ?, ?, ?)",
+            (page_id, last_version_id, status, reason))
+
+        self._uncommitted += 1
+        if (self._uncommitted >= self.batch_size or
+                time.monotonic() - self._last_commit >= COMMIT_INTERVAL):
+            self.commit()
+
+    def _remove_page(self, page_id):
+        # Only needed when updating an existing database. (When bulk loading a
+        # new one, there's nothing to remove, and there are no indexes yet to
+        # make this fast.)
+        if self.incremental:
+            self.connection.execute("DELETE FROM term_changes WHERE page_id = ?", (page_id,))
+            self.connection.execute("DELETE FROM pages WHERE id = ?", (page_id,))
+
+    def write_page(self, page, key_terms=None, timings=None):
+        """
+        Write an analyzed page and its term changes. If `key_terms` is a set of
+        terms, only changes to those terms are written. If `timings` is a dict
+        of stage names to seconds, it's stored in the page's `timings` column.
+        """
+        self._remove_page(page['id'])
+        net_terms = net_change(*page['terms'])
+        self.connection.execute(
+            "INSERT INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (page['id'],
+             page['first_id'],
+             page['last_id'],
+             page['url'],
+             f'https://monitoring.envirodatagov.org/page/{page["id"]}/{page["first_id"]}..{page["last_id"]}',
+             page['title'],
+             page['status'],
+             page['first_date'],
+             page['last_date'],
+             page['percent_changed'],
+             timings and json.dumps(timings, separators=(',', ':')),))
+
+        self.connection.executemany(
+            "INSERT INTO term_changes VALUES (?, ?, ?)",
+            ((page['id'], self.term_id(term), count)
+             for term, count in net_terms.items()
+             if (key_terms is None or term in key_terms)))
+
+        self.record_page(page['id'], page['last_id'], self.CHANGED)
+
+    def term_id(self, term):
+        """Get the ID of a term, adding it to the `terms` table if needed."""
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            term_id = self._next_term_id
+            self._next_term_id += 1
+            self.connection.execute("INSERT INTO terms VALUES (?, ?)", (term_id, term))
+            self.term_ids[term] = term_id
+        return term_id
+
+    def commit(self):
+        self.connection.commit()
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
+
+    def finish(self):
+        """
+        Commit any remaining pages, build indexes, and switch the database out
+        of bulk loading mode.
+        """
+        self.commit()
+        self.connection.executescript("""
+            CREATE UNIQUE INDEX IF NOT EXISTS pages_page_id ON pages (id);
+            CREATE INDEX IF NOT EXISTS pages_percent_changed ON pages (percent_changed);
+            CREATE INDEX IF NOT EXISTS pages_url ON pages (url COLLATE NOCASE);
+            CREATE INDEX IF NOT EXISTS pages_title ON pages (title COLLATE NOCASE);
+
+            CREATE UNIQUE INDEX IF NOT EXISTS terms_term ON terms (term);
+
+            CREATE UNIQUE INDEX IF NOT EXISTS term_changes_key ON term_changes (page_id, term_id);
+            CREATE INDEX IF NOT EXISTS term_changes_term ON term_changes (term_id);
+            CREATE INDEX IF NOT EXISTS term_changes_change_count ON term_changes (change_count);
+
+            ANALYZE;
+            PRAGMA synchronous = FULL;
+            PRAGMA journal_mode = DELETE;
+        """)
+
+
+def write_page_to_sqlite(page, db=None, key_terms=None, timings=None):
     if not db:
         return
 
-    net_terms = net_change(*page['terms'])
-    db.execute("INSERT INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-               (page['id'],
-                page['first_id'],
-                page['last_id'],
-                page['url'],
-                f'https://monitoring.envirodatagov.org/page/{page["id"]}/{page["first_id"]}..{page["last_id"]}',
-                page['title'],
-                page['status'],
-                page['first_date'],
-                page['last_date'],
-                page['percent_changed'],))
-
-    db.executemany("INSERT INTO term_changes VALUES (?, ?, ?)",
-                   ((page['id'], term, count)
-                    for term, count in net_terms.items()
-                    if (key_terms is None or term in key_terms)))
-    db.commit()
+    db.write_page(page, key_terms, timings)
 
 
+def record_page_in_sqlite(page, db=None, status=PageDatabase.UNCHANGED, reason=None):
+    """
+    Record that a page from web-monitoring-db was analyzed but had no results
+    to write (because it had no changes, was skipped, or failed).
+    """
+    if not db:
+        return
 
+    latest = page['latest'] and page['latest']['uuid']
+    db.record_page(page['uuid'], latest or '', status, reason)
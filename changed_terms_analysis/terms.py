@@ -7,7 +7,6 @@ KEY_TERMS = (
     'brownfield',
     'clean energy',
     'climate',
-    'climate',
     'compliance',
     'cost-effective',
     'costs',
@@ -0,0 +1,222 @@
+import multiprocessing.util
+from pathlib import Path
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+
+class _Connection:
+    """
+    A connection to a cache file for one thread, plus the hits and uses of
+    cached texts that haven't been saved to it yet.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.writes = 0
+        self.hits = 0
+        self.used = set()
+        self.lock = threading.Lock()
+
+
+# Connections for each cache file and thread in this process. `TextCache`
+# objects get copied to worker processes along with each page, so connections
+# (and unsaved hits) are kept here instead of on the objects.
+_connections = {}
+_connections_pid = None
+_connections_lock = threading.Lock()
+
+
+class TextCache:
+    """
+    A persistent, on-disk cache of the text extracted from versions. Version
+    bodies never change once captured, so extracted text can be cached forever
+    (or until it is evicted to keep the cache under `max_size` bytes, least
+    recently used first).
+
+    The cache is a SQLite database, and is safe to share across processes:
+    each process (and thread) opens its own connection the first time it uses
+    the cache. Cached values can be `None`, e.g. to record that a version could
+    not be parsed.
+
+    Reading from the cache doesn't write to it, so readers in different
+    processes don't have to wait on each other. Hits are counted in memory and
+    saved with the next write (or every `HIT_SAVE_INTERVAL` hits, or when the
+    process exits), and when a text was last used is only updated if it was
+    more than `USE_INTERVAL` seconds ago, so eviction order is approximate.
+
+    Examples
+    --------
+    >>> cache = TextCache('text-cache.sqlite')
+    >>> cache.get_or_load('readability:abc123', lambda: 'Some text')
+    'Some text'
+    >>> cache.get_or_load('readability:abc123', lambda: 'Never called')
+    'Some text'
+    """
+
+    # How often (in writes from one process) to check the size of the cache.
+    EVICTION_INTERVAL = 100
+
+    # How many hits from one process to count in memory before saving them.
+    HIT_SAVE_INTERVAL = 100
+
+    # Seconds after a text was last used before using it again is recorded.
+    USE_INTERVAL = 10 * 60
+
+    def __init__(self, path, max_size=1024 * 1024 * 1024):
+        self.path = Path(path)
+        self.max_size = max_size
+
+    @property
+    def _current(self):
+        global _connections, _connections_pid
+        key = (str(self.path), threading.get_ident())
+        with _connections_lock:
+            # Connections can't be shared across processes, so each process
+            # starts fresh.
+            if _connections_pid != os.getpid():
+                _connections = {}
+                _connections_pid = os.getpid()
+            current = _connections.get(key)
+            if current is None:
+                current = _connections[key] = _Connection(self._connect())
+                # Save any hits that are still unsaved when the process exits.
+                multiprocessing.util.Finalize(None, self._save_usage,
+                                              args=(current,), exitpriority=10)
+            return current
+
+    @property
+    def connection(self):
+        return self._current.connection
+
+    def _connect(self):
+        # Unsaved hits are saved from the main thread when the process exits.
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level=None,
+                                     check_same_thread=False)
+        connection.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+
+            CREATE TABLE IF NOT EXISTS texts (
+                key TEXT NOT NULL PRIMARY KEY,
+                text BLOB,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS texts_last_used ON texts (last_used);
+
+            CREATE TABLE IF NOT EXISTS stats (
+                name TEXT NOT NULL PRIMARY KEY,
+                count INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO stats VALUES ('hits', 0), ('misses', 0),
+                                               ('evictions', 0);
+        """)
+        return connection
+
+    def get_or_load(self, key, load):
+        """
+        Get the cached text for `key`. If it is not in the cache, call `load()`
+        to get it and add it to the cache.
+        """
+        found, text = self.get(key)
+        if found:
+            return text
+
+        text = load()
+        self.set(key, text)
+        return text
+
+    def get(self, key):
+        """
+        Get a tuple of whether `key` is in the cache and its text (which may be
+        `None` either way).
+        """
+        current = self._current
+        row = current.connection.execute('SELECT text, last_used FROM texts WHERE key = ?',
+                                         (key,)).fetchone()
+        if row:
+            with current.lock:
+                current.hits += 1
+                if time.time() - row[1] > self.USE_INTERVAL:
+                    current.used.add(key)
+            if current.hits >= self.HIT_SAVE_INTERVAL:
+                self._save_usage(current)
+            return True, row[0] and zlib.decompress(row[0]).decode('utf-8')
+
+        return False, None
+
+    def set(self, key, text):
+        """Add the text for `key` to the cache, counting it as a miss."""
+        current = self._current
+        connection = current.connection
+        data = text is not None and zlib.compress(text.encode('utf-8')) or None
+        with connection:
+            connection.execute('BEGIN')
+            connection.execute('INSERT OR REPLACE INTO texts VALUES (?, ?, ?, ?)',
+                               (key, data, len(data or b''), time.time()))
+            self._count('misses', connection=connection)
+            self._write_usage(current)
+
+        current.writes += 1
+        if current.writes % self.EVICTION_INTERVAL == 0:
+            self.evict()
+
+    def _save_usage(self, current):
+        """Save the hits and uses of texts that were only counted in memory."""
+        if current.hits or current.used:
+            with current.connection:
+                current.connection.execute('BEGIN')
+                self._write_usage(current)
+
+    def _write_usage(self, current):
+        with current.lock:
+            now = time.time()
+            current.connection.executemany('UPDATE texts SET last_used = ? WHERE key = ?',
+                                           ((now, key) for key in current.used))
+            self._count('hits', current.hits, connection=current.connection)
+            current.hits = 0
+            current.used.clear()
+
+    def evict(self):
+        """
+        Remove the least recently used texts until the cache is under its
+        maximum size.
+        """
+        connection = self.connection
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM texts').fetchone()[0]
+            if total <= self.max_size:
+                return
+
+            evicted = 0
+            rows = connection.execute('SELECT key, size FROM texts ORDER BY last_used').fetchall()
+            for key, size in rows:
+                if total <= self.max_size:
+                    break
+                connection.execute('DELETE FROM texts WHERE key = ?', (key,))
+                total -= size
+                evicted += 1
+            self._count('evictions', evicted)
+
+    def stats(self):
+        """
+        Get a dict of hit, miss, and eviction counts and the total size. Hits in
+        other processes that are still running may not be counted yet.
+        """
+        connection = self.connection
+        with _connections_lock:
+            currents = [current for (path, _), current in _connections.items()
+                        if path == str(self.path)]
+        for current in currents:
+            self._save_usage(current)
+        result = dict(connection.execute('SELECT name, count FROM stats'))
+        result['size'] = connection.execute('SELECT COALESCE(SUM(size), 0) FROM texts').fetchone()[0]
+        return result
+
+    def _count(self, name, count=1, connection=None):
+        (connection or self.connection).execute('UPDATE stats SET count = count + ? WHERE name = ?',
+                                (count, name))
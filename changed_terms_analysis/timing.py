@@ -0,0 +1,156 @@
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import math
+import os
+import resource
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+
+# Durations are counted in histogram buckets whose bounds grow by this factor,
+# so percentiles are accurate to within about 5% without keeping every
+# duration. Durations up to `MIN_DURATION` seconds all go in the first bucket.
+BUCKET_GROWTH = 1.1
+MIN_DURATION = 1e-6
+
+
+class StageTimes:
+    """
+    The count, total, and maximum of the durations of a stage, and a histogram
+    of them for estimating percentiles. Uses the same amount of memory no
+    matter how many durations are added.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = Counter()
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if seconds <= MIN_DURATION:
+            bucket = 0
+        else:
+            bucket = 1 + int(math.log(seconds / MIN_DURATION, BUCKET_GROWTH))
+        self.buckets[bucket] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.buckets.update(other.buckets)
+
+    def percentile(self, fraction):
+        """Estimate a percentile (as a fraction from 0 to 1) of the durations."""
+        if not self.count:
+            return 0.0
+        rank = min(self.count - 1, max(0, round(fraction * (self.count - 1))))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen > rank:
+                break
+        # The middle of the bucket (on a log scale).
+        return min(self.max, MIN_DURATION * BUCKET_GROWTH ** max(0, bucket - 0.5))
+
+
+class Timings:
+    """
+    Collects how long each stage of the analysis pipeline takes, and how many
+    bytes each stage processed. Timings from other processes can be combined
+    with `merge()`. Safe to use from multiple threads.
+
+    `record_peak_memory()` records the peak resident memory (RSS) of the
+    current process, which is kept for each process in `peak_memory`.
+
+    Examples
+    --------
+    >>> timings = Timings()
+    >>> with timings.stage('diff', size=len(text)):
+    ...     diff = do_diff(text)
+    >>> timings.summary()['diff']['count']
+    1
+    """
+
+    def __init__(self):
+        self.stages = defaultdict(StageTimes)
+        self.sizes = Counter()
+        # Process IDs to peak resident memory in bytes.
+        self.peak_memory = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, size=0):
+        """
+        Time the code in this context as part of the stage `name`. If the size
+        of the data isn't known up front, set `size` on the yielded object.
+        """
+        start = time.perf_counter()
+        measurement = SimpleNamespace(size=size)
+        try:
+            yield measurement
+        finally:
+            self.record(name, time.perf_counter() - start, measurement.size)
+
+    def record(self, name, seconds, size=0):
+        with self._lock:
+            self.stages[name].add(seconds)
+            self.sizes[name] += size
+
+    def record_peak_memory(self):
+        """Record the peak resident memory of this process so far."""
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes; macOS reports bytes.
+        if sys.platform != 'darwin':
+            peak *= 1024
+        with self._lock:
+            pid = os.getpid()
+            self.peak_memory[pid] = max(peak, self.peak_memory.get(pid, 0))
+
+    def merge(self, other):
+        """Add all the timings from another `Timings` object to this one."""
+        with self._lock:
+            for name, times in other.stages.items():
+                self.stages[name].merge(times)
+            self.sizes.update(other.sizes)
+            for pid, peak in other.peak_memory.items():
+                self.peak_memory[pid] = max(peak, self.peak_memory.get(pid, 0))
+
+    def totals(self):
+        """Get the total seconds spent in each stage."""
+        with self._lock:
+            return {name: times.total for name, times in self.stages.items()}
+
+    def summary(self):
+        """
+        Get a dict with the count, total, percentiles, and bytes processed for
+        each stage. Percentiles are estimates (see `StageTimes`).
+        """
+        result = {}
+        with self._lock:
+            for name, times in self.stages.items():
+                result[name] = {
+                    'count': times.count,
+                    'total_seconds': times.total,
+                    'p50_seconds': times.percentile(0.5),
+                    'p90_seconds': times.percentile(0.9),
+                    'p99_seconds': times.percentile(0.99),
+                    'max_seconds': times.max,
+                    'bytes': self.sizes[name],
+                    'bytes_per_second': times.total and self.sizes[name] / times.total,
+                }
+        return result
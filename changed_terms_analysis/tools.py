@@ -1,9 +1,14 @@
-from collections import Counter
+from collections import Counter, deque
 import concurrent.futures
+import json
 from nltk.corpus import stopwords
+import os
 import re
 import requests
-from retry import retry
+import requests.adapters
+import time
+from web_monitoring.diff import differs
+from .hosts import MAX_CONNECTIONS_PER_HOST, backoff_delay, host_policy
 
 
 BOUNDARY = re.compile(r'[\r\n\s.;:!?,<>{}[\]\-–—\|\\/]+')
@@ -39,27 +44,23 @@ class CharacterToWordDiffs:
 
     def __init__(self, change_type):
         self.diff = []
-        self.buffer = ''
+        self.buffer = []
         self.has_change = False
         self.change_type = change_type
 
     def add_text(self, text, is_change):
-        remaining = text
-        remaining = IGNORABLE.sub('', remaining)
-        while True:
-            boundary = BOUNDARY.search(remaining)
-            if boundary is None:
-                break
-
-            if boundary.start() > 0:
+        # Splitting gives the pieces between boundaries, so every piece but the
+        # last is followed by a boundary that completes the current word.
+        *pieces, remaining = BOUNDARY.split(IGNORABLE.sub('', text))
+        for piece in pieces:
+            if piece:
                 self.has_change = is_change or self.has_change
-                self.buffer += remaining[:boundary.start()]
+                self.buffer.append(piece)
             self.complete_word()
-            remaining = remaining[boundary.end():]
 
         if remaining:
             self.has_change = is_change or self.has_change
-            self.buffer += remaining
+            self.buffer.append(remaining)
 
         if text == '':
             self.complete_word()
@@ -68,18 +69,126 @@ class CharacterToWordDiffs:
         # TODO: get the stem instead of the word?
         # TODO: recognize `. ` as a sentence break and use it when n-gramming
         #       Probably similar things like em dashes, semicolons, commas
-        word = self.buffer.lower()
-        change_type = self.change_type if self.has_change else 0
-        if word:
+        if self.buffer:
+            word = ''.join(self.buffer).lower()
+            change_type = self.change_type if self.has_change else 0
             self.diff.append((change_type, word))
+            self.buffer.clear()
 
         self.has_change = False
-        self.buffer = ''
+
+
+def tokenize(text):
+    """
+    Split text into normalized words using the same rules as
+    `CharacterToWordDiffs` (lowercase, ignorable punctuation removed).
+    """
+    return [word.lower()
+            for word in BOUNDARY.split(IGNORABLE.sub('', text))
+            if word]
+
+
+# diff-match-patch works on strings, so each unique word is encoded as a single
+# character. Skip over control characters and the surrogate range, which
+# can't be used in Python strings that get passed to C code.
+_TOKEN_CHARACTER_START = 0x100
+_SURROGATE_START = 0xD800
+_SURROGATE_END = 0xE000
+
+# The most unique words that can be encoded (one per remaining code point).
+MAX_WORD_TOKENS = (0x110000 - _TOKEN_CHARACTER_START
+                   - (_SURROGATE_END - _SURROGATE_START))
+
+
+class TooManyWordsError(ValueError):
+    """
+    Raised when texts have more unique words than can be encoded for a
+    word-level diff (see `MAX_WORD_TOKENS`).
+    """
+
+
+def _token_character(token_id):
+    if token_id >= MAX_WORD_TOKENS:
+        raise TooManyWordsError(f'Texts have more than {MAX_WORD_TOKENS} unique '
+                                f'words and can\'t be diffed word-by-word')
+    codepoint = _TOKEN_CHARACTER_START + token_id
+    if codepoint >= _SURROGATE_START:
+        codepoint += _SURROGATE_END - _SURROGATE_START
+    return chr(codepoint)
+
+
+class WordEncoder:
+    """
+    Encodes sequences of words as strings with one character per unique word,
+    so they can be diffed word-by-word with diff-match-patch. Words get the
+    same character every time, so an encoder can be used for many versions of
+    a page and their encoded texts reused between diffs.
+    """
+
+    def __init__(self):
+        self.token_ids = {}
+        self.tokens = []
+
+    def encode(self, tokens):
+        characters = []
+        for token in tokens:
+            token_id = self.token_ids.get(token)
+            if token_id is None:
+                token_id = self.token_ids[token] = len(self.tokens)
+                self.tokens.append(token)
+            characters.append(_token_character(token_id))
+        return ''.join(characters)
+
+    def decode_diff(self, raw_diff):
+        """
+        Convert a diff of encoded strings to a list of `(operation, word)`
+        tuples.
+        """
+        return [(operation, self.tokens[self._token_id(character)])
+                for operation, characters in raw_diff
+                for character in characters]
+
+    @staticmethod
+    def _token_id(character):
+        codepoint = ord(character)
+        if codepoint >= _SURROGATE_END:
+            codepoint -= _SURROGATE_END - _SURROGATE_START
+        return codepoint - _TOKEN_CHARACTER_START
+
+    def diff(self, encoded_a, encoded_b):
+        """Diff two encoded strings and decode the result."""
+        return self.decode_diff(differs.html_source_diff(encoded_a, encoded_b)['diff'])
+
+
+def word_level_diff(text_a, text_b, tokenizer=tokenize):
+    """
+    Diff two texts word-by-word instead of character-by-character. Both texts
+    are tokenized first (with `tokenizer`), each unique word is mapped to an
+    integer ID, and the sequences of IDs are diffed.
+
+    Returns a list of `(operation, word)` tuples, like the character diffs from
+    `web_monitoring.diff.differs`, so it works with
+    `calculate_percent_changed()`. Use `split_word_diff()` to get the
+    `(deletions, additions)` format of `CharacterToWordDiffs.word_diffs()`.
+    """
+    encoder = WordEncoder()
+    return encoder.diff(encoder.encode(tokenizer(text_a)),
+                        encoder.encode(tokenizer(text_b)))
+
+
+def split_word_diff(diff):
+    """
+    Split a diff from `word_level_diff()` into separate deletion and addition
+    word diffs, in the same format as `CharacterToWordDiffs.word_diffs()`.
+    """
+    deletions = [item for item in diff if item[0] != 1]
+    additions = [item for item in diff if item[0] != -1]
+    return deletions, additions
 
 
 def changed_ngrams(diff, size=1):
-    token_buffer = []
-    change_buffer = []
+    token_buffer = deque(maxlen=size)
+    change_buffer = deque(maxlen=size)
     for item in diff:
         if item[1] in STOPWORDS:
             token_buffer.clear()
@@ -87,11 +196,50 @@ def changed_ngrams(diff, size=1):
         else:
             token_buffer.append(item[1])
             change_buffer.append(item[0])
-            if len(token_buffer) == size:
-                if any(change_buffer):
-                    yield ' '.join(token_buffer)
-                token_buffer.pop(0)
-                change_buffer.pop(0)
+            if len(token_buffer) == size and any(change_buffer):
+                yield ' '.join(token_buffer)
+
+
+def count_changed_ngrams(diff, max_size=1, counter=None):
+    """
+    Count every changed n-gram from 1 to `max_size` words long in a single pass
+    over a word diff. This is equivalent to updating a counter with
+    `changed_ngrams(diff, size)` for each size, but skips building the n-grams
+    that can't include a changed word, so it's faster when most words are
+    unchanged (and about the same when most are changed).
+
+    If `counter` is set, counts are added to it. Returns the counter.
+    """
+    if counter is None:
+        counter = Counter()
+
+    tokens = deque(maxlen=max_size)
+    # Words since the last changed word, up to `max_size` (no n-gram ending at
+    # the current word includes a change). Only n-grams longer than this are
+    # counted.
+    since_change = max_size
+    for change, token in diff:
+        if token in STOPWORDS:
+            tokens.clear()
+            since_change = max_size
+            continue
+
+        tokens.append(token)
+        if change:
+            since_change = 0
+            counter[token] += 1
+        elif since_change < max_size:
+            since_change += 1
+        if since_change == max_size or len(tokens) == 1:
+            continue
+
+        term = token
+        for size in range(2, len(tokens) + 1):
+            term = f'{tokens[-size]} {term}'
+            if size > since_change:
+                counter[term] += 1
+
+    return counter
 
 
 def net_change(deletions, additions):
@@ -107,11 +255,96 @@ def net_change(deletions, additions):
     return net_count
 
 
-@retry(tries=3, delay=1)
+# Keep a reference to the real session class. `requests_cache` replaces
+# `requests.Session` while it's installed, and we never want to cache these.
+_Session = requests.Session
+_session = None
+_session_pid = None
+
+
+def http_session():
+    """
+    Get a requests session for this process. It keeps connections alive and
+    pools them by host, so repeated requests to archive storage and the
+    readability server don't need a new TCP/TLS handshake every time.
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        session = _Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=100,
+                                                pool_maxsize=MAX_CONNECTIONS_PER_HOST)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _session = session
+        _session_pid = os.getpid()
+    return _session
+
+
+# Seconds to wait for a connection to a host.
+CONNECT_TIMEOUT = 5
+
+# Responses with these statuses mean the host is overloaded or temporarily
+# broken, and are worth retrying.
+RETRYABLE_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+# Most seconds to wait before a retry when a host sends `Retry-After`, so one
+# response can't tie up a thread for an hour.
+MAX_RETRY_AFTER = 60
+
+
+def retry_after(response):
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return 0
+
+
+def request(method, url, tries=3, timeout=15, rate_limited=True, **request_args):
+    """
+    Make an HTTP request with the session for this process, following the
+    limits for the URL's host (see `hosts.py`). Connection errors, timeouts,
+    and overloaded responses (`RETRYABLE_STATUSES`) are retried up to `tries`
+    times in total, with exponential backoff and jitter. Other error responses
+    are returned as-is.
+
+    `timeout` is the minimum seconds to wait for a response; it's extended
+    automatically for hosts that have been slow. Set `rate_limited=False` to
+    skip the host's requests-per-second limit (e.g. for local services).
+    """
+    policy = host_policy(url)
+    for attempt in range(tries):
+        trial = policy.check()
+        delay = 0
+        with policy.slot(rate_limited):
+            start = time.perf_counter()
+            try:
+                response = http_session().request(
+                    method, url,
+                    timeout=(CONNECT_TIMEOUT, policy.timeout(timeout)),
+                    **request_args)
+            except (requests.ConnectionError, requests.Timeout):
+                policy.record(time.perf_counter() - start, ok=False, trial=trial)
+                if attempt == tries - 1:
+                    raise
+            except BaseException:
+                # The circuit breaker is waiting on the trial's result.
+                if trial:
+                    policy.record(time.perf_counter() - start, ok=False, trial=trial)
+                raise
+            else:
+                ok = response.status_code not in RETRYABLE_STATUSES
+                policy.record(response.elapsed.total_seconds(), ok=ok, trial=trial)
+                if ok or attempt == tries - 1:
+                    return response
+                delay = min(retry_after(response), MAX_RETRY_AFTER)
+                response.close()
+
+        time.sleep(max(delay, backoff_delay(attempt)))
+
+
 def load_url(url, **request_args):
-    response = requests.get(url, timeout=15, **request_args)
-    if not response.ok:
-        response.raise_for_status()
+    response = request('GET', url, **request_args)
+    response.raise_for_status()
 
     content_type = response.headers.get('content-type', '')
     if 'charset=' not in content_type:
@@ -120,20 +353,144 @@ def load_url(url, **request_args):
     return response
 
 
-@retry(tries=3, delay=1)
-def load_url_readability(url):
-    response = load_url(f'http://localhost:7323/proxy', params={'url': url})
+READABILITY_SERVER = 'http://localhost:7323'
 
-    # Return None if the URL was unparseable.
-    if response.status_code >= 400:
+
+def parse_readability(html, url):
+    """
+    Parse an HTML document that was already loaded with the readability
+    server. Returns a dict with the main content of the page as `text` and
+    `html`, or None if it couldn't be parsed.
+    """
+    response = request('POST', f'{READABILITY_SERVER}/all',
+                       params={'url': url},
+                       data=html.encode('utf-8'),
+                       headers={'Content-Type': 'text/html; charset=utf-8'},
+                       timeout=60,
+                       rate_limited=False)
+
+    # The server responds with 422 if the document was unparseable and 413 if
+    # it was too big to parse.
+    if response.status_code in (413, 422):
         return None
-    else:
-        return response
+
+    response.raise_for_status()
+    return response.json()
+
+
+class ReadabilityError(Exception):
+    ...
+
+
+# Most documents, and most bytes of JSON, to send to the readability server in
+# one request to `/batch`. The server rejects requests over 100 MB.
+MAX_BATCH_ITEMS = 16
+MAX_BATCH_BYTES = 64 * 1024 * 1024
+
+
+def parse_readability_batch(items, fields=('text',)):
+    """
+    Parse several HTML documents or URLs with the readability server. Each item
+    is a dict with a `url` and (optionally) the already loaded `html` for it.
+    Returns a list of the parsed result for each item (a dict with the
+    requested `fields`), or None if it couldn't be parsed or was too big.
+
+    Items are sent in as few requests as possible, with at most
+    `MAX_BATCH_ITEMS` items and `MAX_BATCH_BYTES` bytes in each. Raises
+    `ReadabilityError` if the server fails to parse an item or stops
+    responding before it sent a result for every item.
+    """
+    results = [None] * len(items)
+    batch = []
+    batch_size = 0
+    for index, item in enumerate(items):
+        data = json.dumps({'id': index, **item}).encode('utf-8')
+        if len(data) > MAX_BATCH_BYTES:
+            # Too big to send at all, so too big to parse.
+            continue
+        if batch and (len(batch) == MAX_BATCH_ITEMS
+                      or batch_size + len(data) > MAX_BATCH_BYTES):
+            _send_readability_batch(batch, items, results, fields)
+            batch = []
+            batch_size = 0
+        batch.append((index, data))
+        batch_size += len(data) + 1
+
+    if batch:
+        _send_readability_batch(batch, items, results, fields)
+    return results
+
+
+def _send_readability_batch(batch, items, results, fields):
+    response = request('POST', f'{READABILITY_SERVER}/batch',
+                       params={'fields': ','.join(fields)},
+                       data=b'{"items":[' + b','.join(data for _, data in batch) + b']}',
+                       headers={'Content-Type': 'application/json'},
+                       timeout=60 + 15 * len(batch),
+                       rate_limited=False,
+                       stream=True)
+    with response:
+        response.raise_for_status()
+
+        received = set()
+        for line in response.iter_lines():
+            if not line:
+                continue
+            item = json.loads(line)
+            received.add(item['id'])
+            if item['status'] == 200:
+                results[item['id']] = item['result']
+            elif item['status'] not in (413, 422):
+                raise ReadabilityError(f'Readability server error {item["status"]} '
+                                       f'for {items[item["id"]]["url"]}: {item.get("error")}')
+
+    # If the server crashed or restarted, the response just ends early. That
+    # isn't the same as a document being unparseable, so don't treat it as
+    # one.
+    missing = [index for index, _ in batch if index not in received]
+    if missing:
+        raise ReadabilityError(f'Readability server stopped responding before parsing '
+                               f'{len(missing)} of {len(batch)} documents '
+                               f'(starting with {items[missing[0]]["url"]})')
+
+
+def load_url_readability(url):
+    """
+    Load a URL with the readability server and get the text of its main
+    content, or None if it couldn't be parsed. To load several URLs at once, use
+    `parse_readability_batch()`.
+    """
+    parsed = parse_readability_batch([{'url': url}])[0]
+    return parsed and parsed['text']
+
+
+def visible_text(html):
+    """
+    Get the visible text of an HTML document with runs of whitespace collapsed.
+    This is the text `differs.html_text_diff()` compares.
+    """
+    # Diffing against an empty document gives the document's whole text as
+    # deletions.
+    diff = differs.html_text_diff(re.sub(r'[\s\r\n]+', ' ', html), '')['diff']
+    return ''.join(text for operation, text in diff if operation != 1)
+
+
+# Threads `parallel()` runs calls in (per process).
+PARALLEL_THREADS = 2 * MAX_CONNECTIONS_PER_HOST
+
+_executor = None
+_executor_pid = None
 
 
 def parallel(*calls):
-    """Run several function calls in parallel threads."""
-    calls = list(calls)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(calls)) as executor:
-        tasks = [executor.submit(call, *args) for call, *args in calls]
-        return [task.result() for task in tasks]
+    """
+    Run several function calls in parallel threads. The threads are shared by
+    all calls in a process, rather than started fresh for each call.
+    """
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = concurrent.futures.ThreadPoolExecutor(max_workers=PARALLEL_THREADS)
+        _executor_pid = os.getpid()
+
+    tasks = [_executor.submit(call, *args) for call, *args in calls]
+    return [task.result() for task in tasks]
@@ -0,0 +1,62 @@
+"""
+Integer IDs for terms, for counting term changes across many pages with
+arrays instead of dicts of term strings.
+
+Examples
+--------
+>>> vocabulary = TermVocabulary()
+>>> pages = [vocabulary.ids({'climate', 'energy'}), vocabulary.ids({'energy'})]
+>>> dict(zip(vocabulary.terms, page_counts(pages).tolist()))
+{'climate': 1, 'energy': 2}
+"""
+import numpy
+
+
+TERM_ID_TYPE = numpy.uint32
+COUNT_TYPE = numpy.int64
+
+
+class TermVocabulary:
+    """
+    Maps terms to integer IDs. IDs are assigned in the order terms are first
+    seen, so `terms[term_id]` is the term with a given ID.
+    """
+
+    def __init__(self, terms=()):
+        self.term_ids = {}
+        self.terms = []
+        for term in terms:
+            self.id(term)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __contains__(self, term):
+        return term in self.term_ids
+
+    def id(self, term):
+        """Get the ID of a term, adding it to the vocabulary if needed."""
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            term_id = self.term_ids[term] = len(self.terms)
+            self.terms.append(term)
+        return term_id
+
+    def ids(self, terms):
+        """Get an array of the IDs of some terms, adding any new ones."""
+        term_id = self.id
+        return numpy.fromiter((term_id(term) for term in terms),
+                              dtype=TERM_ID_TYPE)
+
+
+def page_counts(term_ids, size=0):
+    """
+    Count how many pages each term is on, given an iterable of arrays of the
+    term IDs for each page (without repeats). Returns an array where the value
+    at each term ID is the number of pages, at least `size` long.
+    """
+    term_ids = list(term_ids)
+    if not term_ids:
+        return numpy.zeros(size, dtype=COUNT_TYPE)
+    return numpy.bincount(numpy.concatenate(term_ids).astype(numpy.intp, copy=False),
+                          minlength=size).astype(COUNT_TYPE, copy=False)
@@ -1,13 +1,31 @@
-from collections import Counter
+from changed_terms_analysis.columnar import ColumnarReader
+from changed_terms_analysis.vocabulary import TermVocabulary, page_counts
 import csv
+from heapq import merge
+from itertools import groupby
 import json
+from multiprocessing import Pool
+import numpy
+import os
+from pathlib import Path
 import re
 import sys
+import tempfile
 
 
-def json_lines(filepath):
-    with open(filepath) as file:
-        for line in file:
+def json_lines(filepath, start=0, end=None):
+    """
+    Yield the parsed JSON from each line in a file. If `start` or `end` are
+    set, only read lines that start between those byte offsets.
+    """
+    with open(filepath, 'rb') as file:
+        if start > 0:
+            file.seek(start - 1)
+            file.readline()
+        while end is None or file.tell() < end:
+            line = file.readline()
+            if not line:
+                break
             if line.strip():
                 yield json.loads(line)
 
@@ -25,26 +43,150 @@ def filter_terms(counter, min_count=5, min_length=2):
             if count > min_count and filter_term(term, length=min_length)}
 
 
+def file_chunks(filepath, count):
+    """Split a file into `count` (start, end) byte ranges."""
+    size = os.path.getsize(filepath)
+    bounds = [size * index // count for index in range(count + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def spill(vocabulary, counts, directory):
+    """
+    Write the terms in a vocabulary and their counts (an array indexed by term
+    ID), sorted by term, to a temp file.
+    """
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=directory,
+                                     suffix='.tsv', delete=False) as file:
+        for term, count in sorted(zip(vocabulary.terms, counts.tolist())):
+            file.write(f'{term}\t{count}\n')
+    return file.name
+
+
+# Number of pages to collect term IDs for before adding them to the counts.
+PAGE_BATCH_SIZE = 1000
+
+
+def count_chunk(filepath, start, end, directory, max_terms):
+    """
+    Count the pages each term changed on in part of an analysis output file.
+    Counts are spilled to sorted temp files whenever there are more than
+    `max_terms` terms in memory. Returns the paths of the temp files.
+    """
+    spilled = []
+    vocabulary = TermVocabulary()
+    counts = page_counts([])
+    batch = []
+
+    def add_batch():
+        nonlocal counts
+        batch_counts = page_counts(batch, len(vocabulary))
+        batch_counts[:len(counts)] += counts
+        counts = batch_counts
+        batch.clear()
+
+    for page_data in json_lines(filepath, start, end):
+        terms = page_data['terms']
+        batch.append(vocabulary.ids(terms[0].keys() | terms[1].keys()))
+        if len(batch) >= PAGE_BATCH_SIZE:
+            add_batch()
+        if len(vocabulary) > max_terms:
+            add_batch()
+            spilled.append(spill(vocabulary, counts, directory))
+            vocabulary = TermVocabulary()
+            counts = page_counts([])
+
+    add_batch()
+    if len(vocabulary):
+        spilled.append(spill(vocabulary, counts, directory))
+    return spilled
+
+
+def read_spilled(path):
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            term, count = line.rstrip('\n').rsplit('\t', 1)
+            yield term, int(count)
+
+
+def count_terms(filepath, workers=None, max_terms=1_000_000):
+    """
+    Count the number of pages each term changed on in an analysis output file.
+    Yields `(term, page_count)` tuples sorted by term.
+
+    The file is split into chunks that are counted in parallel, and memory use
+    is bounded by spilling partial counts to disk and merging them.
+    """
+    workers = workers or os.cpu_count()
+    with tempfile.TemporaryDirectory() as directory:
+        chunks = file_chunks(filepath, workers)
+        with Pool(workers) as pool:
+            spilled = pool.starmap(count_chunk,
+                                   ((filepath, start, end, directory, max_terms)
+                                    for start, end in chunks))
+
+        sorted_counts = merge(*(read_spilled(path)
+                                for paths in spilled
+                                for path in paths))
+        for term, counts in groupby(sorted_counts, key=lambda item: item[0]):
+            yield term, sum(count for _, count in counts)
+
+
+def count_columnar_terms(path):
+    """
+    Count the number of pages each term changed on in analysis output in the
+    columnar format. Yields `(term, page_count)` tuples sorted by term.
+    """
+    results = ColumnarReader(path)
+    terms = results.terms()
+    offsets = numpy.frombuffer(results.offsets, dtype=numpy.uint64).astype(numpy.int64)
+    term_ids = numpy.frombuffer(results.term_ids, dtype=numpy.uint32)
+    page_ends = offsets[::2]
+    counts = numpy.zeros(len(terms), dtype=numpy.int64)
+
+    # Work on batches of pages so we don't need a copy of every term ID at
+    # once. Each (page, term) pair is only counted once, even if the term was
+    # both removed and added.
+    for first_page in range(0, results.meta['pages'], COLUMNAR_BATCH_SIZE):
+        last_page = min(first_page + COLUMNAR_BATCH_SIZE, results.meta['pages'])
+        ends = page_ends[first_page:last_page + 1]
+        pages = numpy.repeat(numpy.arange(first_page, last_page), numpy.diff(ends))
+        ids = term_ids[ends[0]:ends[-1]].astype(numpy.int64)
+        unique_pairs = numpy.unique(pages * len(terms) + ids)
+        counts += page_counts([unique_pairs % len(terms)], len(terms))
+
+    yield from sorted(zip(terms, counts.tolist()))
+
+
+# Number of pages to count at a time in columnar results.
+COLUMNAR_BATCH_SIZE = 100_000
+
+
 if __name__ == '__main__':
     import argparse
-    parser = argparse.ArgumentParser(description='List all unique terms in an analysis’s JSON output as a CSV.')
-    parser.add_argument('PATH', help='Path to analysis JSON output file.')
+    parser = argparse.ArgumentParser(description='List all unique terms in an analysis’s output as a CSV.')
+    parser.add_argument('PATH', help='Path to analysis JSON output file or columnar output directory.')
     parser.add_argument('--sort', help='Sort by `count` or `term`.', default='term')
     parser.add_argument('--count', type=int, help='Only include terms that changed on at least this many pages.', default=1)
     parser.add_argument('--length', type=int, help='Only include terms that with at least this many characters.', default=2)
+    parser.add_argument('--workers', type=int, help='Number of processes to use (default: one per CPU).')
+    parser.add_argument('--max-terms', type=int, default=1_000_000,
+                        help='Maximum terms each process keeps in memory before spilling them to disk.')
     options = parser.parse_args()
 
-    terms_and_pages = Counter()
-    for page_data in json_lines(options.PATH):
-        terms = page_data['terms']
-        all_terms = set(terms[0].keys()).union(set(terms[1].keys()))
-        terms_and_pages.update({term: 1 for term in all_terms})
-
-    results = sorted(filter_terms(terms_and_pages,
-                                  min_count=options.count,
-                                  min_length=options.length).items(),
-                     key=lambda x: options.sort == 'term' and x[0] or x[1],
-                     reverse=(options.sort == 'count'))
+    path = Path(options.PATH)
+    if path.is_dir():
+        term_counts = count_columnar_terms(path)
+    else:
+        term_counts = count_terms(path, workers=options.workers,
+                                  max_terms=options.max_terms)
+
+    # Terms come out of the counting functions sorted and unique, so each one
+    # is only filtered once.
+    results = ((term, page_count)
+               for term, page_count in term_counts
+               if page_count > options.count and filter_term(term, length=options.length))
+    if options.sort == 'count':
+        results = sorted(results, key=lambda x: x[1], reverse=True)
 
     writer = csv.writer(sys.stdout)
     writer.writerow(['term', 'page_count'])
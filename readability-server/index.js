@@ -6,6 +6,26 @@
  * Make a request to `/proxy?url={some_url}` and it will return a plain-text
  * version of the main body of the content at `some_url`.
  *
+ * To parse many pages at once, `POST /batch` with a JSON body like:
+ *
+ *     {"items": [{"id": "a", "url": "https://..."},
+ *                {"id": "b", "url": "https://...", "html": "<!doctype html>..."}]}
+ *
+ * Items with `html` are parsed as-is (`url` is only used to resolve links);
+ * others are loaded from `url`. The response is newline-delimited JSON, with
+ * one line for each item as soon as it's done (not necessarily in order):
+ *
+ *     {"id": "b", "status": 200, "result": {"text": "...", "html": "...", ...}}
+ *     {"id": "a", "status": 422, "error": "Could not parse content for ..."}
+ *
+ * Set `?fields=text,title` to only include some fields in each result.
+ *
+ * Parsed results are cached by the hash of the HTML and URL (links in the
+ * `html` result are resolved against the URL), so the same page is only
+ * parsed once (up to `CACHE_SIZE` megabytes of results, default 256). Get
+ * statistics about the worker queue, parse times, and the cache from
+ * `/metrics`.
+ *
  * NOTE: Readability is wrapped in a worker pool implementation because it is
  * not async. It is also not published as a standalone package on NPM, so we
  * depend directly on its git URL. See the source here:
@@ -15,13 +35,19 @@
 
 const AbortController = require('abort-controller');
 const bodyParser = require('body-parser');
+const crypto = require('crypto');
 const express = require('express');
 const fetch = require('node-fetch');
+const LruCache = require('./lru-cache');
 const WorkerPool = require('./worker-pool');
 
 const serverPort = process.env.PORT || 7323;
+const parseTimeout = 45000;
 
 const workerPool = new WorkerPool('./readability-worker.js', 10);
+const parseCache = new LruCache({
+  maxSize: (parseInt(process.env.CACHE_SIZE, 10) || 256) * 1024 * 1024
+});
 const app = express();
 
 // TODO: add logging/warning for slow requests
@@ -37,6 +63,44 @@ function timedFetch (url, options = {}) {
   return fetch(url, options).finally(() => clearTimeout(timer));
 }
 
+async function fetchText (url) {
+  const upstream = await timedFetch(url);
+  return upstream.text();
+}
+
+/**
+ * Parse an HTML document with Readability in a worker, or get the result from
+ * the cache if the same HTML was already parsed for the same URL. Resolves to
+ * null if the document couldn't be parsed.
+ */
+async function parseHtml (html, url, force) {
+  const hash = crypto.createHash('sha256')
+    .update(url || '')
+    .update('\0')
+    .update(html)
+    .digest('hex');
+  const key = `${force ? 'force' : 'check'}:${hash}`;
+  const cached = parseCache.get(key);
+  if (cached !== undefined) return cached;
+
+  const parsed = await workerPool.send({timeout: parseTimeout}, html, url, force);
+  const size = parsed
+    ? parsed.text.length + parsed.html.length + parsed.nonContentHtml.length
+    : 1;
+  parseCache.set(key, parsed, size);
+  return parsed;
+}
+
+function pickFields (object, fields) {
+  if (!fields) return object;
+
+  const result = {};
+  for (const field of fields) {
+    if (field in object) result[field] = object[field];
+  }
+  return result;
+}
+
 async function loadUrlMiddleware (request, response, next) {
   const url = request.query.url;
 
@@ -49,9 +113,7 @@ async function loadUrlMiddleware (request, response, next) {
   console.log('Proxying', url);
 
   try {
-    const upstream = await timedFetch(url);
-    const html = await upstream.text();
-    request.htmlBody = html;
+    request.htmlBody = await fetchText(url);
     next();
   }
   catch (error) {
@@ -69,7 +131,9 @@ async function loadUrlMiddleware (request, response, next) {
 
 const _bodyMiddleware = bodyParser.text({type: 'text/*', limit: '5MB'})
 function readBodyMiddleware (request, response, next) {
-  _bodyMiddleware(request, response, function () {
+  _bodyMiddleware(request, response, function (error) {
+    if (error) return next(error);
+
     const url = request.query.url;
     console.log('Processing POST data for:', url);
     request.htmlBody = request.body;
@@ -83,7 +147,7 @@ async function readabilityMiddleware (request, response, next) {
 
   try {
     const html = request.htmlBody;
-    const parsed = await workerPool.send({timeout: 45000}, html, url, force);
+    const parsed = await parseHtml(html, url, force);
 
     if (parsed) {
       request.parsedPage = parsed;
@@ -152,6 +216,59 @@ app.post('/all', readBodyMiddleware, readabilityMiddleware, function (request, r
   response.json(request.parsedPage);
 });
 
+const _batchBodyMiddleware = bodyParser.json({limit: '100MB'});
+
+app.post('/batch', _batchBodyMiddleware, async function (request, response) {
+  const items = request.body && request.body.items;
+  if (!Array.isArray(items)) {
+    return response.status(400).json({
+      error: 'The request body must be a JSON object with an array of `items`.'
+    });
+  }
+
+  const force = booleanTrue.test(request.query.force);
+  const fields = request.query.fields && request.query.fields.split(',');
+  console.log(`Processing batch of ${items.length} items`);
+
+  response.type('application/x-ndjson');
+  await Promise.all(items.map(async (item, index) => {
+    const id = item.id != null ? item.id : index;
+    let result;
+    try {
+      const html = item.html != null ? item.html : await fetchText(item.url);
+      const parsed = await parseHtml(html, item.url, force);
+      if (parsed) {
+        result = {id, status: 200, result: pickFields(parsed, fields)};
+      }
+      else {
+        result = {id, status: 422, error: `Could not parse content for ${item.url}`};
+      }
+    }
+    catch (error) {
+      const status = error.name === 'AbortError' ? 504 : 500;
+      result = {id, status, error: error.message};
+      console.error(error);
+      console.error('  While processing batch item:', item.url);
+    }
+    response.write(`${JSON.stringify(result)}\n`);
+  }));
+  response.end();
+});
+
+app.get('/metrics', function (request, response) {
+  response.json({
+    workers: workerPool.metrics(),
+    cache: {
+      entries: parseCache.count,
+      size: parseCache.size,
+      maxSize: parseCache.maxSize,
+      hits: parseCache.hits,
+      misses: parseCache.misses,
+      evictions: parseCache.evictions
+    }
+  });
+});
+
 app.listen(serverPort, function () {
   console.log(`Listening on port ${serverPort}`);
 });
@@ -0,0 +1,63 @@
+/**
+ * A simple least-recently-used cache with a maximum total size. Each entry
+ * has a size (e.g. in bytes) that's set when you add it; when the total size
+ * of all entries goes over `maxSize`, the least recently used ones are
+ * removed.
+ *
+ * `get()` returns `undefined` for keys that aren't in the cache, so any other
+ * value (including `null`) can be cached.
+ */
+'use strict';
+
+class LruCache {
+  constructor ({maxSize = 256 * 1024 * 1024} = {}) {
+    this.maxSize = maxSize;
+    this.size = 0;
+    this.hits = 0;
+    this.misses = 0;
+    this.evictions = 0;
+    // Maps iterate in insertion order, so the first entry is always the least
+    // recently used one.
+    this._entries = new Map();
+  }
+
+  get count () {
+    return this._entries.size;
+  }
+
+  get (key) {
+    const entry = this._entries.get(key);
+    if (!entry) {
+      this.misses++;
+      return undefined;
+    }
+
+    this.hits++;
+    this._entries.delete(key);
+    this._entries.set(key, entry);
+    return entry.value;
+  }
+
+  set (key, value, size = 1) {
+    this.delete(key);
+    if (size > this.maxSize) return;
+
+    this._entries.set(key, {value, size});
+    this.size += size;
+    while (this.size > this.maxSize) {
+      const oldest = this._entries.keys().next().value;
+      this.delete(oldest);
+      this.evictions++;
+    }
+  }
+
+  delete (key) {
+    const entry = this._entries.get(key);
+    if (entry) {
+      this._entries.delete(key);
+      this.size -= entry.size;
+    }
+  }
+}
+
+module.exports = LruCache;
@@ -0,0 +1,51 @@
+const chai = require('chai');
+const expect = chai.expect;
+
+const LruCache = require('../lru-cache');
+
+describe('LruCache', function() {
+  it('returns undefined for missing keys', function() {
+    const cache = new LruCache();
+    expect(cache.get('missing')).to.equal(undefined);
+    expect(cache.misses).to.equal(1);
+  });
+
+  it('can cache null values', function() {
+    const cache = new LruCache();
+    cache.set('key', null);
+    expect(cache.get('key')).to.equal(null);
+    expect(cache.hits).to.equal(1);
+  });
+
+  it('removes the least recently used entries when full', function() {
+    const cache = new LruCache({maxSize: 3});
+    cache.set('a', 1);
+    cache.set('b', 2);
+    cache.set('c', 3);
+    cache.get('a');
+    cache.set('d', 4);
+
+    expect(cache.get('b')).to.equal(undefined);
+    expect(cache.get('a')).to.equal(1);
+    expect(cache.count).to.equal(3);
+    expect(cache.evictions).to.equal(1);
+  });
+
+  it('counts the size of each entry', function() {
+    const cache = new LruCache({maxSize: 10});
+    cache.set('a', 'x', 6);
+    cache.set('b', 'y', 6);
+
+    expect(cache.get('a')).to.equal(undefined);
+    expect(cache.size).to.equal(6);
+  });
+
+  it('does not cache entries bigger than the maximum size', function() {
+    const cache = new LruCache({maxSize: 10});
+    cache.set('a', 'x', 5);
+    cache.set('b', 'y', 11);
+
+    expect(cache.get('a')).to.equal('x');
+    expect(cache.get('b')).to.equal(undefined);
+  });
+});
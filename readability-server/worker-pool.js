@@ -76,10 +76,22 @@ class SimpleWorker {
   }
 }
 
+// Number of recent task durations to keep for calculating percentiles.
+const LATENCY_SAMPLES = 1000;
+
+function percentile (sortedValues, fraction) {
+  if (!sortedValues.length) return 0;
+  const index = Math.round(fraction * (sortedValues.length - 1));
+  return sortedValues[index];
+}
+
 class WorkerPool {
   constructor (sourcePath, size) {
+    this.size = size;
     this._free = [];
     this._waiting = [];
+    this._stats = {completed: 0, failed: 0, timedOut: 0};
+    this._latencies = [];
 
     for (let i = size; i > 0; i--) {
       this._free.push(new SimpleWorker(sourcePath));
@@ -88,16 +100,56 @@ class WorkerPool {
 
   async send (options, ...args) {
     const worker = await this.acquire();
+    const start = Date.now();
     let result;
     try {
       result = await worker.send(options, ...args);
+      this._stats.completed++;
+    }
+    catch (error) {
+      if (error.message === 'TIMEDOUT') {
+        this._stats.timedOut++;
+      }
+      else {
+        this._stats.failed++;
+      }
+      throw error;
     }
     finally {
+      this._recordLatency(Date.now() - start);
       this.release(worker);
     }
     return result;
   }
 
+  /**
+   * Get statistics about the pool: how many workers are busy, how many tasks
+   * are waiting for a worker, how many tasks have finished, and percentiles
+   * for how long recent tasks took (in milliseconds).
+   */
+  metrics () {
+    const latencies = this._latencies.slice().sort((a, b) => a - b);
+    return {
+      size: this.size,
+      busy: this.size - this._free.length,
+      queued: this._waiting.length,
+      ...this._stats,
+      latencyMs: {
+        p50: percentile(latencies, 0.5),
+        p90: percentile(latencies, 0.9),
+        p99: percentile(latencies, 0.99),
+        max: latencies.length ? latencies[latencies.length - 1] : 0
+      }
+    };
+  }
+
+  _recordLatency (milliseconds) {
+    this._latencies.push(milliseconds);
+    if (this._latencies.length > LATENCY_SAMPLES) {
+      this._latencies.shift();
+    }
+  }
+
   acquire () {
     return new Promise((resolve) => {
       let worker = this._free.pop();
@@ -0,0 +1,21 @@
+"""
+Check that `count_changed_ngrams()` counts the same n-grams as calling
+`changed_ngrams()` for each size.
+"""
+from collections import Counter
+from hypothesis import given, settings, strategies as st
+from changed_terms_analysis.tools import changed_ngrams, count_changed_ngrams
+
+
+# A few words (and stopwords), so n-grams repeat.
+words = st.sampled_from(['climate', 'change', 'energy', 'jobs', 'the', 'of'])
+diffs = st.lists(st.tuples(st.sampled_from([-1, 0, 0, 1]), words), max_size=40)
+
+
+@given(diffs, st.integers(min_value=1, max_value=5))
+@settings(max_examples=500)
+def test_count_changed_ngrams_matches_changed_ngrams(diff, max_size):
+    expected = Counter()
+    for size in range(1, max_size + 1):
+        expected.update(changed_ngrams(diff, size))
+    assert count_changed_ngrams(diff, max_size) == expected
@@ -0,0 +1,145 @@
+"""
+Check that `CharacterToWordDiffs` gives exactly the same word diffs as the
+original (quadratic) implementation of `add_text()`, which is kept here as a
+reference.
+"""
+import random
+from hypothesis import given, settings, strategies as st
+from changed_terms_analysis.tools import BOUNDARY, IGNORABLE, CharacterToWordDiffs
+
+
+class ReferenceCharacterToWordDiffs:
+    """The original implementation of `CharacterToWordDiffs`."""
+
+    @classmethod
+    def word_diffs(cls, text_changes):
+        insertions = cls(1)
+        deletions = cls(-1)
+
+        for change in text_changes:
+            if change[0] == 0 or change[0] == 1:
+                insertions.add_text(change[1], change[0] != 0)
+
+            if change[0] == 0 or change[0] == -1:
+                deletions.add_text(change[1], change[0] != 0)
+
+        insertions.add_text('', False)
+        deletions.add_text('', False)
+
+        return deletions.diff, insertions.diff
+
+    def __init__(self, change_type):
+        self.diff = []
+        self.buffer = ''
+        self.has_change = False
+        self.change_type = change_type
+
+    def add_text(self, text, is_change):
+        remaining = text
+        remaining = IGNORABLE.sub('', remaining)
+        while True:
+            boundary = BOUNDARY.search(remaining)
+            if boundary is None:
+                break
+
+            if boundary.start() > 0:
+                self.has_change = is_change or self.has_change
+                self.buffer += remaining[:boundary.start()]
+            self.complete_word()
+            remaining = remaining[boundary.end():]
+
+        if remaining:
+            self.has_change = is_change or self.has_change
+            self.buffer += remaining
+
+        if text == '':
+            self.complete_word()
+
+    def complete_word(self):
+        word = self.buffer.lower()
+        change_type = self.change_type if self.has_change else 0
+        if word:
+            self.diff.append((change_type, word))
+
+        self.has_change = False
+        self.buffer = ''
+
+
+BOUNDARY_CHARACTERS = ' \t\r\n.;:!?,<>{}[]-–—|\\/'
+IGNORABLE_CHARACTERS = '\'‘’"“”'
+
+words = st.text(alphabet='abcXYZéß0' + IGNORABLE_CHARACTERS, min_size=1, max_size=8)
+boundaries = st.text(alphabet=BOUNDARY_CHARACTERS, min_size=1, max_size=6)
+operations = st.sampled_from((-1, 0, 1))
+
+
+@st.composite
+def segment_texts(draw):
+    """
+    Text for a diff segment: runs of words and boundaries, which may be empty,
+    and may start or end in the middle of a word.
+    """
+    pieces = draw(st.lists(st.one_of(words, boundaries), max_size=12))
+    return ''.join(pieces)
+
+
+@st.composite
+def diffs(draw):
+    """
+    A character diff, including empty segments and words split across
+    segments with different operations.
+    """
+    diff = []
+    for operation, text in draw(st.lists(st.tuples(operations, segment_texts()), max_size=20)):
+        if draw(st.booleans()) and len(text) > 1:
+            # Split the text somewhere (maybe mid-word) between this segment
+            # and one with another operation.
+            split = draw(st.integers(min_value=1, max_value=len(text) - 1))
+            diff.append((operation, text[:split]))
+            diff.append((draw(operations), text[split:]))
+        else:
+            diff.append((operation, text))
+    return diff
+
+
+def assert_same_word_diffs(diff):
+    assert (CharacterToWordDiffs.word_diffs(diff)
+            == ReferenceCharacterToWordDiffs.word_diffs(diff))
+
+
+@given(diffs())
+@settings(max_examples=500)
+def test_matches_reference(diff):
+    assert_same_word_diffs(diff)
+
+
+@given(st.text(alphabet='ab ' + BOUNDARY_CHARACTERS + IGNORABLE_CHARACTERS, max_size=200))
+def test_matches_reference_on_one_segment(text):
+    for operation in (-1, 0, 1):
+        assert_same_word_diffs([(operation, text)])
+
+
+def large_unchanged_text(size, seed):
+    """
+    Make a text of about `size` characters with long words and long runs of
+    boundary characters, so the quadratic reference implementation can still
+    get through it quickly.
+    """
+    generator = random.Random(seed)
+    pieces = []
+    length = 0
+    while length < size:
+        word = 'w' * generator.randint(2000, 10000) + str(generator.random())
+        boundary = ''.join(generator.choices(BOUNDARY_CHARACTERS, k=generator.randint(1, 500)))
+        pieces.append(word)
+        pieces.append(boundary)
+        length += len(word) + len(boundary)
+    return ''.join(pieces)
+
+
+@given(diffs(), st.integers(min_value=0), st.integers(min_value=0, max_value=2**32))
+@settings(max_examples=3, deadline=None)
+def test_matches_reference_with_multi_megabyte_unchanged_span(diff, position, seed):
+    span = large_unchanged_text(3_000_000, seed)
+    position = position % (len(diff) + 1)
+    assert_same_word_diffs(diff[:position] + [(0, span)] + diff[position:])